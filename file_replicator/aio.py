@@ -0,0 +1,254 @@
+"""Asyncio counterparts to the blocking functions in file_replicator.lib.
+
+These share one event loop (and one filesystem watching thread) between any number
+of replication sessions, rather than using threads of their own.
+"""
+
+import asyncio
+import collections
+import os.path
+import threading
+import time
+
+from watchdog.observers import Observer
+
+from .git import GitIgnoreChecker
+from .lib import (
+    BULK_CHUNK_SIZE,
+    READ_CHUNK_SIZE,
+    RECEIVER_CODE,
+    STORM_EVENTS_PER_SECOND,
+    TAR_COMMAND,
+    CopyFileEventHandler,
+    GitIgnoreCopyFileEventHandler,
+    chunk_for_sender,
+    get_ignore_spec,
+    iter_files_to_replicate,
+    raise_on_sender_error,
+    sender_args,
+)
+
+__all__ = [
+    "SyncResult",
+    "make_file_replicator",
+    "replicate_all_files",
+    "replicate_files_on_change",
+]
+
+SyncResult = collections.namedtuple("SyncResult", ["filenames", "timestamp"])
+
+
+class AsyncFileReplicator:
+    """Async context manager giving a copy_file(<filename>, ...) coroutine function.
+
+    See make_file_replicator().
+    """
+
+    def __init__(
+        self,
+        local_tar,
+        remote_tar,
+        src_dir,
+        dest_parent_dir,
+        bash_connection_command,
+        clean_out_first=False,
+        debugging=False,
+    ):
+        self.local_tar = local_tar.negotiate(remote_tar)
+        self.remote_tar = remote_tar
+        self.src_dir = os.path.abspath(src_dir)
+        self.dest_dir = os.path.join(
+            os.path.abspath(dest_parent_dir), os.path.basename(self.src_dir)
+        )
+        self.bash_connection_command = bash_connection_command
+        self.clean_out_first = clean_out_first
+        self.debugging = debugging
+        self.process = None
+        self.lock = None
+
+    async def __aenter__(self):
+        self.lock = asyncio.Lock()
+        self.process = await asyncio.create_subprocess_exec(
+            *self.bash_connection_command, stdin=asyncio.subprocess.PIPE
+        )
+        # Get the remote end up and running waiting for tar files.
+        receiver_code = RECEIVER_CODE.format(
+            dest_dir=self.dest_dir,
+            clean_out_first=str(self.clean_out_first).lower(),
+            receiver_tar=self.remote_tar.receiver_cmd_str(),
+        )
+        self.process.stdin.write(receiver_code.encode())
+        await self.process.stdin.drain()
+        return self.copy_file
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.process.stdin.close()
+        await self.process.wait()
+
+    async def copy_file(self, *src_filenames):
+        src_filenames = [os.path.abspath(f) for f in src_filenames]
+        rel_src_filenames = [os.path.relpath(f, self.src_dir) for f in src_filenames]
+        if self.debugging:
+            if len(src_filenames) == 1:
+                print(f"Sending {src_filenames[0]}...")
+            else:
+                print(f"Sending {len(src_filenames)} files in bulk...")
+        for chunk in chunk_for_sender(self.local_tar, rel_src_filenames):
+            await self.send_archive(chunk)
+
+    async def send_archive(self, rel_src_filenames):
+        # Archives must not be interleaved on the way to the receiver.
+        async with self.lock:
+            self.process.stdin.write(TAR_COMMAND)
+            with sender_args(self.local_tar, rel_src_filenames) as (sender_cmd, names):
+                sender = await asyncio.create_subprocess_exec(
+                    *sender_cmd,
+                    cwd=self.src_dir,
+                    stdin=names,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                _, stderr = await asyncio.gather(
+                    self._pump(sender.stdout), sender.stderr.read()
+                )
+                returncode = await sender.wait()
+        if returncode:
+            raise RuntimeError(f"ERROR: sender tar exited with {returncode}")
+        raise_on_sender_error(stderr)
+
+    async def _pump(self, stdout):
+        while True:
+            chunk = await stdout.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            self.process.stdin.write(chunk)
+            await self.process.stdin.drain()
+
+
+def make_file_replicator(
+    local_tar,
+    remote_tar,
+    src_dir,
+    dest_parent_dir,
+    bash_connection_command,
+    clean_out_first=False,
+    debugging=False,
+):
+    """Return an async context manager for replicating files over a "bash connection".
+
+    It gives a copy_file(<filename>, ...) coroutine function, which is otherwise as
+    given by file_replicator.lib.make_file_replicator().
+    """
+    return AsyncFileReplicator(
+        local_tar,
+        remote_tar,
+        src_dir,
+        dest_parent_dir,
+        bash_connection_command,
+        clean_out_first=clean_out_first,
+        debugging=debugging,
+    )
+
+
+async def replicate_all_files(
+    src_dir,
+    copy_file,
+    use_gitignore=True,
+    debugging=False,
+    use_git=True,
+    only_git_changes=False,
+):
+    """Copy all files in src_dir using the copy_file() coroutine function.
+
+    Files are as given by file_replicator.lib.iter_files_to_replicate(), and are copied
+    in batches rather than one at a time.
+    """
+    batch = []
+    for filename in iter_files_to_replicate(
+        src_dir, use_gitignore, use_git, only_git_changes, debugging
+    ):
+        batch.append(filename)
+        if len(batch) == BULK_CHUNK_SIZE:
+            await copy_file(*batch)
+            batch = []
+    if batch:
+        await copy_file(*batch)
+
+
+# One observer (and so one watching thread) is shared by all sessions.
+_observer = None
+_observer_users = 0
+_observer_lock = threading.Lock()
+
+
+def _schedule_watch(event_handler, src_dir):
+    global _observer, _observer_users
+    with _observer_lock:
+        if _observer is None:
+            _observer = Observer()
+            _observer.daemon = True
+            _observer.start()
+        _observer_users += 1
+        return _observer.schedule(event_handler, src_dir, recursive=True)
+
+
+def _unschedule_watch(watch):
+    global _observer, _observer_users
+    with _observer_lock:
+        _observer.unschedule(watch)
+        _observer_users -= 1
+        if not _observer_users:
+            _observer.stop()
+            _observer = None
+
+
+async def replicate_files_on_change(
+    src_dir,
+    copy_file,
+    timeout=None,
+    use_gitignore=True,
+    debugging=False,
+    storm_threshold=STORM_EVENTS_PER_SECOND,
+    use_git=True,
+):
+    """Asynchronously iterate over SyncResults as changes in src_dir are copied.
+
+    Files are copied with the copy_file() coroutine function. If provided, the timeout
+    indicates when to stop after that many seconds of no change. Changes are ignored
+    following the same rules as replicate_all_files() (with the same use_git).
+    """
+    src_dir = os.path.abspath(src_dir)
+    loop = asyncio.get_event_loop()
+    changes = asyncio.Queue()
+
+    def enqueue(*filenames):
+        loop.call_soon_threadsafe(changes.put_nowait, filenames)
+
+    handler_kwargs = dict(debugging=debugging, storm_threshold=storm_threshold)
+    spec = None
+    if use_gitignore:
+        spec = get_ignore_spec(src_dir, use_gitignore, use_git)
+        event_handler = GitIgnoreCopyFileEventHandler(enqueue, spec, **handler_kwargs)
+    else:
+        event_handler = CopyFileEventHandler(enqueue, **handler_kwargs)
+
+    watch = _schedule_watch(event_handler, src_dir)
+    try:
+        while True:
+            try:
+                filenames = await asyncio.wait_for(changes.get(), 0.5)
+            except asyncio.TimeoutError:
+                await loop.run_in_executor(None, event_handler.flush_storm)
+                if changes.empty() and timeout:
+                    elapsed = time.time() - event_handler.last_event_timestamp
+                    if elapsed > timeout:
+                        if debugging:
+                            print(f"No changes detected for {elapsed} seconds.")
+                        return
+                continue
+            await copy_file(*filenames)
+            yield SyncResult(filenames, time.time())
+    finally:
+        _unschedule_watch(watch)
+        if isinstance(spec, GitIgnoreChecker):
+            spec.close()
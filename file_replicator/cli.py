@@ -1,17 +1,73 @@
+import contextlib
+import json
 import os.path
+import shlex
+import sys
 
 import click
 
 import file_replicator
 
-from .lib import make_file_replicator, replicate_all_files, replicate_files_on_change
+from .daemon import Daemon, DaemonError, send_command
+from .lib import (
+    AUTO_RATE,
+    STORM_EVENTS_PER_SECOND,
+    Destination,
+    SendScheduler,
+    make_file_replicator,
+    replicate_all_files,
+    replicate_files_on_change,
+)
+from .plan import make_plan
+from .state import FileStateStore
 from .tar_adapter import *
+from .verify import reconcile as reconcile_files
+
+
+class RateType(click.ParamType):
+    """A rate in bytes per second, with an optional K, M or G suffix, or "auto"."""
+
+    name = "rate"
+    multipliers = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+    def convert(self, value, param, ctx):
+        if value is None or value == AUTO_RATE or isinstance(value, (int, float)):
+            return value
+        number, suffix = value[:-1], value[-1:].upper()
+        if suffix not in self.multipliers:
+            number, suffix = value, ""
+        try:
+            rate = float(number) * self.multipliers[suffix]
+        except ValueError:
+            self.fail(f"{value} is not a rate e.g. 500K, 2M or auto", param, ctx)
+        if rate <= 0:
+            self.fail("The rate must be positive", param, ctx)
+        return rate
+
+
+bulk_rate_option = click.option(
+    "--bulk-rate",
+    type=RateType(),
+    default=None,
+    help="Limit sending big files and the initial replication to this many bytes "
+    "per second (e.g. 500K or 2M), or to half the measured throughput with auto. "
+    "Small changed files are sent first, without limit.",
+)
 
 
 @click.command()
 @click.argument("src_dir")
 @click.argument("dest_parent_dir")
 @click.argument("connection_command", nargs=-1)
+@click.option(
+    "--also-to",
+    "extra_destinations",
+    type=(str, str),
+    multiple=True,
+    metavar="DEST_PARENT_DIR CONNECTION_COMMAND",
+    help="Also replicate to another destination, with the connection command given "
+    "as one (quoted) argument. May be repeated.",
+)
 @click.option(
     "--clean-out-first",
     is_flag=True,
@@ -23,6 +79,13 @@ from .tar_adapter import *
     default=True,
     help="Perform (or not) an initial replication of all files.",
 )
+@click.option(
+    "--reconcile",
+    is_flag=True,
+    default=False,
+    help="Initially replicate just the files which differ in the destination, found "
+    "by comparing hashes of both (not with --also-to).",
+)
 @click.option(
     "--replicate-on-change / --no-replicate-on-change",
     default=True,
@@ -33,6 +96,36 @@ from .tar_adapter import *
     default=True,
     help="Use .gitignore (or not) to filter files.",
 )
+@click.option(
+    "--git / --no-git",
+    "use_git",
+    default=True,
+    help="Ask git (if available) for the files to initially replicate, rather than "
+    "walking the source directory.",
+)
+@click.option(
+    "--only-git-changes",
+    is_flag=True,
+    default=False,
+    help="Initially replicate just the files git sees as modified or untracked, "
+    "assuming the destination already has the rest.",
+)
+@click.option(
+    "--storm-threshold",
+    type=click.IntRange(min=0),
+    default=STORM_EVENTS_PER_SECOND,
+    show_default=True,
+    help="Changes per second above which files are rescanned and sent in bulk "
+    "once the changes settle (0 to disable).",
+)
+@bulk_rate_option
+@click.option(
+    "--plan",
+    is_flag=True,
+    default=False,
+    help="Just output (as JSON) what would be sent and an estimate of how long it "
+    "would take, without sending anything.",
+)
 @click.option(
     "--debugging", is_flag=True, default=False, help="Print debugging information."
 )
@@ -85,10 +178,17 @@ def main(
     src_dir,
     dest_parent_dir,
     connection_command,
+    extra_destinations,
     clean_out_first,
     with_initial_replication,
+    reconcile,
     replicate_on_change,
     gitignore,
+    use_git,
+    only_git_changes,
+    storm_threshold,
+    bulk_rate,
+    plan,
     debugging,
     local_tar_fn,
     remote_tar_fn,
@@ -118,17 +218,36 @@ def main(
     (the use of "--" prevents any further processing of command line arguments by
     file-replicator, leaving them all for docker)
 
-    Initially, all files and required directories are recursively copied. Then it
-    waits for changes before copying each modified or new file. This can be modified
-    with the switches.
+    To replicate to several destinations at once, each file being read just once,
+    add more with --also-to e.g.:
+
+    \b
+        file-replicator my_code_dir /home/code \\
+            --also-to /home/code "docker exec -i other_container bash" \\
+            -- docker exec -i a_container bash
+
+    Initially, all files and required directories are recursively copied, while at
+    the same time watching for changes before copying each modified or new file.
+    Changed files are copied ahead of the initial copying. This can be modified with
+    the switches.
+
+    Bursts of changes (e.g. switching git branch) are detected and sent together
+    once they have settled, rather than one file at a time.
+
+    Changes to small files are sent ahead of big files and the initial copying,
+    which can be limited to a rate with --bulk-rate.
 
     Note that empty directories are not replicated until they contain a file.
 
+    To see what would be sent and how long it would take, without sending anything,
+    use --plan. With --reconcile, this only counts files which differ in the
+    destination.
+
     Lastly, the only time the tool deletes files or directories is if called with
     the optional --clean-out-first switch.
 
     """
-    if not connection_command:
+    if not connection_command and not plan:
         raise click.UsageError(
             "Please provide a connection command to access the destination server."
         )
@@ -138,6 +257,36 @@ def main(
         )
     if not os.path.exists(src_dir) or not os.path.isdir(src_dir):
         raise click.UsageError("The source destination must exist and be a directory.")
+    if reconcile and extra_destinations:
+        raise click.UsageError(
+            "--reconcile compares with just one destination, so can't be used with "
+            "--also-to."
+        )
+    for extra_dest_parent_dir, extra_connection_command in extra_destinations:
+        if not os.path.isabs(extra_dest_parent_dir):
+            raise click.UsageError(
+                "The destination parent directory must be an absolute path."
+            )
+        if not shlex.split(extra_connection_command):
+            raise click.UsageError(
+                "Please provide a connection command to access the destination server."
+            )
+
+    if plan:
+        # Only the plan goes to stdout (so it can be piped), any debugging to stderr.
+        with contextlib.redirect_stdout(sys.stderr):
+            result = make_plan(
+                src_dir,
+                dest_parent_dir,
+                connection_command,
+                use_gitignore=gitignore,
+                use_git=use_git,
+                only_git_changes=only_git_changes,
+                reconcile=reconcile,
+                debugging=debugging,
+            )
+        click.echo(json.dumps(result, indent=2))
+        return
 
     local_tar = local_tar_fn()
     remote_tar = remote_tar_fn(connection_command)
@@ -146,6 +295,17 @@ def main(
         print(f"Remote tar: {remote_tar}")
     if not isinstance(remote_tar, GnuTarAdapter):
         click.UsageError("Cannot use non-gnu remote tar!")
+    destinations = []
+    for extra_dest_parent_dir, extra_connection_command in extra_destinations:
+        extra_connection_command = shlex.split(extra_connection_command)
+        extra_remote_tar = remote_tar_fn(extra_connection_command)
+        if debugging:
+            print(f"Remote tar for {extra_connection_command}: {extra_remote_tar}")
+        destinations.append(
+            Destination(
+                extra_remote_tar, extra_dest_parent_dir, extra_connection_command
+            )
+        )
 
     if clean_out_first:
         click.secho(
@@ -160,12 +320,196 @@ def main(
         connection_command,
         clean_out_first=clean_out_first,
         debugging=debugging,
+        extra_destinations=destinations,
     ) as copy_file:
-        if with_initial_replication:
-            replicate_all_files(
-                src_dir, copy_file, use_gitignore=gitignore, debugging=debugging
+        if with_initial_replication and reconcile:
+            report = reconcile_files(
+                src_dir,
+                dest_parent_dir,
+                connection_command,
+                copy_file,
+                use_gitignore=gitignore,
+                use_git=use_git,
+                debugging=debugging,
             )
+            click.secho(
+                f"Copied {len(report.differing_files)} differing files.", fg="green"
+            )
+            for path in report.extra_paths:
+                click.secho(f"Only in destination: {path}", fg="yellow")
+            with_initial_replication = False
         if replicate_on_change:
             replicate_files_on_change(
-                src_dir, copy_file, use_gitignore=gitignore, debugging=debugging
+                src_dir,
+                copy_file,
+                use_gitignore=gitignore,
+                debugging=debugging,
+                storm_threshold=storm_threshold or None,
+                known_state=FileStateStore(),
+                initial_replication=with_initial_replication,
+                use_git=use_git,
+                only_git_changes=only_git_changes,
+                bulk_rate=bulk_rate,
+            )
+        elif with_initial_replication:
+            scheduler = SendScheduler(
+                copy_file, debugging=debugging, bulk_rate=bulk_rate
             )
+            scheduler.start()
+            try:
+                replicate_all_files(
+                    src_dir,
+                    scheduler.copy_file_in_background,
+                    use_gitignore=gitignore,
+                    debugging=debugging,
+                    use_git=use_git,
+                    only_git_changes=only_git_changes,
+                )
+            finally:
+                scheduler.close()
+
+
+DEFAULT_SOCKET_PATH = os.path.expanduser("~/.file-replicator.sock")
+
+socket_option = click.option(
+    "--socket",
+    "socket_path",
+    envvar="FILE_REPLICATOR_SOCKET",
+    default=DEFAULT_SOCKET_PATH,
+    show_default=True,
+    help="The daemon's control socket (or set FILE_REPLICATOR_SOCKET).",
+)
+
+
+@click.command()
+@socket_option
+@click.option(
+    "--debugging", is_flag=True, default=False, help="Print debugging information."
+)
+@click.version_option(version=file_replicator.__version__)
+def daemon_main(socket_path, debugging):
+    """Run a long-lived daemon which replicates files, as file-replicator does.
+
+    Replications are added, removed, paused, resumed and resynced using
+    file-replicator-ctl through a UNIX control socket. The daemon keeps everything
+    needed (connections, file watchers and what it knows of each file) so this is
+    quick, even when removing and later adding back the same replication.
+    """
+    try:
+        daemon = Daemon(debugging=debugging)
+    except DaemonError as e:
+        raise click.ClickException(str(e))
+    click.secho(f"Listening on {socket_path}", fg="green")
+    try:
+        daemon.serve(socket_path)
+    except DaemonError as e:
+        raise click.ClickException(str(e))
+
+
+@click.group()
+@socket_option
+@click.version_option(version=file_replicator.__version__)
+@click.pass_context
+def ctl(ctx, socket_path):
+    """Control a running file-replicator-daemon."""
+    ctx.obj = socket_path
+
+
+def send_ctl_command(socket_path, command, **arguments):
+    try:
+        return send_command(socket_path, command, **arguments)
+    except OSError as e:
+        raise click.ClickException(f"Cannot connect to daemon at {socket_path}: {e}")
+    except DaemonError as e:
+        raise click.ClickException(str(e))
+
+
+@ctl.command()
+@click.argument("name")
+@click.argument("src_dir")
+@click.argument("dest_parent_dir")
+@click.argument("connection_command", nargs=-1, required=True)
+@click.option(
+    "--clean-out-first",
+    is_flag=True,
+    default=False,
+    help="Optionally start by cleaning out the destination directory.",
+)
+@click.option(
+    "--gitignore / --no-gitignore",
+    default=True,
+    help="Use .gitignore (or not) to filter files.",
+)
+@click.option(
+    "--remote-tar-detect",
+    is_flag=True,
+    default=False,
+    help="Attempt to detect remote tar flavor.",
+)
+@bulk_rate_option
+@click.pass_obj
+def add(
+    socket_path,
+    name,
+    src_dir,
+    dest_parent_dir,
+    connection_command,
+    clean_out_first,
+    gitignore,
+    remote_tar_detect,
+    bulk_rate,
+):
+    """Start replicating SRC_DIR to DEST_PARENT_DIR as NAME (see file-replicator)."""
+    send_ctl_command(
+        socket_path,
+        "add",
+        name=name,
+        src_dir=os.path.abspath(src_dir),
+        dest_parent_dir=dest_parent_dir,
+        connection_command=list(connection_command),
+        clean_out_first=clean_out_first,
+        use_gitignore=gitignore,
+        detect_remote_tar=remote_tar_detect,
+        bulk_rate=bulk_rate,
+    )
+
+
+@ctl.command()
+@click.argument("name")
+@click.pass_obj
+def remove(socket_path, name):
+    """Stop replicating NAME."""
+    send_ctl_command(socket_path, "remove", name=name)
+
+
+@ctl.command()
+@click.argument("name")
+@click.argument("subtree", default=".")
+@click.pass_obj
+def resync(socket_path, name, subtree):
+    """Send all files in SUBTREE (of the source, default all) of NAME again."""
+    count = send_ctl_command(socket_path, "resync", name=name, subtree=subtree)
+    click.echo(f"Resending {count} files.")
+
+
+@ctl.command()
+@click.argument("name")
+@click.pass_obj
+def pause(socket_path, name):
+    """Pause sending files for NAME (changes are queued)."""
+    send_ctl_command(socket_path, "pause", name=name)
+
+
+@ctl.command()
+@click.argument("name")
+@click.pass_obj
+def resume(socket_path, name):
+    """Resume sending files for NAME."""
+    send_ctl_command(socket_path, "resume", name=name)
+
+
+@ctl.command()
+@click.pass_obj
+def status(socket_path):
+    """Show the status of all replications as JSON."""
+    click.echo(json.dumps(send_ctl_command(socket_path, "status"), indent=2))
@@ -0,0 +1,331 @@
+import contextlib
+import json
+import os
+import os.path
+import socket
+import socketserver
+import stat
+import threading
+
+from .lib import (
+    BULK,
+    STORM_EVENTS_PER_SECOND,
+    SendScheduler,
+    iter_files_to_replicate,
+    make_file_replicator,
+    replicate_files_on_change,
+)
+from .state import FileStateStore
+from .tar_adapter import GnuTarAdapter, detect_local_tar, detect_remote_tar
+
+__all__ = ["Daemon", "DaemonError", "send_command"]
+
+
+class DaemonError(Exception):
+    pass
+
+
+class ReplicationSession:
+    """One running replication of a source directory to a destination.
+
+    The session keeps its connection, file watcher and known state for as long as it
+    runs, and can be paused, resumed or asked to resync part of the source.
+    """
+
+    def __init__(
+        self,
+        local_tar,
+        remote_tar,
+        src_dir,
+        dest_parent_dir,
+        connection_command,
+        known_state,
+        clean_out_first=False,
+        use_gitignore=True,
+        storm_threshold=STORM_EVENTS_PER_SECOND,
+        bulk_rate=None,
+        debugging=False,
+    ):
+        self.src_dir = os.path.abspath(src_dir)
+        self.dest_parent_dir = dest_parent_dir
+        self.connection_command = connection_command
+        self.known_state = known_state
+        self.use_gitignore = use_gitignore
+        self.debugging = debugging
+        self.stack = contextlib.ExitStack()
+        copy_file = self.stack.enter_context(
+            make_file_replicator(
+                local_tar,
+                remote_tar,
+                self.src_dir,
+                dest_parent_dir,
+                connection_command,
+                clean_out_first=clean_out_first,
+                debugging=debugging,
+            )
+        )
+        self.scheduler = SendScheduler(
+            copy_file, debugging=debugging, bulk_rate=bulk_rate, known_state=known_state
+        )
+        self.scheduler.start()
+        self.terminate_event = threading.Event()
+        self.thread = threading.Thread(
+            target=replicate_files_on_change,
+            args=(self.src_dir, copy_file),
+            kwargs=dict(
+                use_gitignore=use_gitignore,
+                debugging=debugging,
+                terminate_event=self.terminate_event,
+                storm_threshold=storm_threshold,
+                initial_replication=True,
+                scheduler=self.scheduler,
+            ),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.terminate_event.set()
+        self.thread.join()
+        try:
+            self.scheduler.close()
+        finally:
+            self.stack.close()
+
+    def resync(self, subtree="."):
+        """Send all files in the subtree (relative to the source) again."""
+        subtree_dir = os.path.normpath(os.path.join(self.src_dir, subtree))
+        if os.path.commonpath([self.src_dir, subtree_dir]) != self.src_dir:
+            raise DaemonError(f"{subtree} is not inside {self.src_dir}")
+        filenames = list(
+            iter_files_to_replicate(
+                self.src_dir,
+                self.use_gitignore,
+                debugging=self.debugging,
+                subtree=os.path.relpath(subtree_dir, self.src_dir),
+            )
+        )
+        if filenames:
+            self.scheduler.copy_file_urgently(*filenames, priority=BULK)
+        return len(filenames)
+
+    def status(self):
+        return {
+            "src_dir": self.src_dir,
+            "dest_parent_dir": self.dest_parent_dir,
+            "connection_command": list(self.connection_command),
+            "running": self.thread.is_alive(),
+            "paused": self.scheduler.paused,
+            "pending": self.scheduler.pending(),
+            "files_sent": self.scheduler.files_sent,
+            "batch_bytes": self.scheduler.batch_sizer.batch_bytes(),
+            "bulk_rate": self.scheduler.bulk_rate,
+            "files_known": len(self.known_state),
+            "error": None
+            if self.scheduler.error is None
+            else str(self.scheduler.error),
+        }
+
+
+class Daemon:
+    """Run replication sessions, kept warm between requests to add or remove them.
+
+    Tar detection is done once, and the known state of each source and destination is
+    kept after its session is removed (unless sending failed), so adding it again
+    doesn't resend everything.
+    """
+
+    def __init__(self, local_tar=None, debugging=False):
+        self.local_tar = local_tar or detect_local_tar()
+        if self.local_tar is None:
+            raise DaemonError("Could not find a suitable local tar.")
+        self.debugging = debugging
+        self.remote_tars = {}
+        self.known_states = {}
+        self.sessions = {}
+        self.lock = threading.RLock()
+        self.ready = threading.Event()
+
+    def remote_tar(self, connection_command, detect=False):
+        if not detect:
+            return GnuTarAdapter()
+        key = tuple(connection_command)
+        if key not in self.remote_tars:
+            self.remote_tars[key] = detect_remote_tar(connection_command)
+        if self.remote_tars[key] is None:
+            raise DaemonError("Could not find a suitable remote tar.")
+        return self.remote_tars[key]
+
+    def _session(self, name):
+        try:
+            return self.sessions[name]
+        except KeyError:
+            raise DaemonError(f"No such replication: {name}")
+
+    def add(
+        self,
+        name,
+        src_dir,
+        dest_parent_dir,
+        connection_command,
+        clean_out_first=False,
+        use_gitignore=True,
+        detect_remote_tar=False,
+        storm_threshold=STORM_EVENTS_PER_SECOND,
+        bulk_rate=None,
+    ):
+        if not connection_command:
+            raise DaemonError("Please provide a connection command.")
+        if not os.path.isabs(dest_parent_dir):
+            raise DaemonError("The destination parent directory must be absolute.")
+        if not os.path.isdir(src_dir):
+            raise DaemonError("The source must exist and be a directory.")
+        with self.lock:
+            if name in self.sessions:
+                raise DaemonError(f"Replication {name} already exists.")
+            key = (os.path.abspath(src_dir), dest_parent_dir, tuple(connection_command))
+            known_state = self.known_states.get(key)
+            if known_state is None or clean_out_first:
+                known_state = self.known_states[key] = FileStateStore()
+            self.sessions[name] = ReplicationSession(
+                self.local_tar,
+                self.remote_tar(connection_command, detect_remote_tar),
+                src_dir,
+                dest_parent_dir,
+                connection_command,
+                known_state,
+                clean_out_first=clean_out_first,
+                use_gitignore=use_gitignore,
+                storm_threshold=storm_threshold,
+                bulk_rate=bulk_rate,
+                debugging=self.debugging,
+            )
+
+    def remove(self, name):
+        with self.lock:
+            session = self._session(name)
+            del self.sessions[name]
+        try:
+            session.stop()
+        finally:
+            if session.scheduler.error is not None:
+                # Files sent just before the failure may never have arrived.
+                self._forget_known_state(session.known_state)
+
+    def _forget_known_state(self, known_state):
+        with self.lock:
+            for key, state in list(self.known_states.items()):
+                if state is known_state:
+                    del self.known_states[key]
+
+    def resync(self, name, subtree="."):
+        return self._session(name).resync(subtree)
+
+    def pause(self, name):
+        self._session(name).scheduler.pause()
+
+    def resume(self, name):
+        self._session(name).scheduler.resume()
+
+    def status(self):
+        with self.lock:
+            return {name: s.status() for name, s in sorted(self.sessions.items())}
+
+    def stop(self):
+        with self.lock:
+            names = list(self.sessions)
+        for name in names:
+            self.remove(name)
+
+    COMMANDS = ("add", "remove", "resync", "pause", "resume", "status")
+
+    def handle(self, request):
+        """Handle a request dict, returning a response dict."""
+        command = request.get("command")
+        if command not in self.COMMANDS:
+            return {"ok": False, "error": f"Unknown command: {command}"}
+        try:
+            result = getattr(self, command)(**request.get("arguments", {}))
+        except DaemonError as e:
+            return {"ok": False, "error": str(e)}
+        except Exception as e:
+            # Anything else (such as a session whose sending has failed) mustn't
+            # leave the client without a response.
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        return {"ok": True, "result": result}
+
+    def serve(self, socket_path):
+        """Serve requests on a UNIX socket until interrupted (or shutdown() is called).
+
+        Each request and response is a line of JSON. Raise DaemonError if another
+        daemon is already listening on the socket.
+        """
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line)
+                    except ValueError as e:
+                        response = {"ok": False, "error": f"Bad request: {e}"}
+                    else:
+                        response = daemon.handle(request)
+                    self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        remove_stale_socket(socket_path)
+        # Only the user may connect, so create the socket without access for others.
+        umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        finally:
+            os.umask(umask)
+        self.server.daemon_threads = True
+        self.ready.set()
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+            os.remove(socket_path)
+            self.stop()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+def remove_stale_socket(socket_path):
+    """Remove a socket left behind by a daemon which is no longer running."""
+    try:
+        st = os.lstat(socket_path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise DaemonError(f"{socket_path} exists and is not a socket.")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+    raise DaemonError(f"A daemon is already listening on {socket_path}.")
+
+
+def send_command(socket_path, command, **arguments):
+    """Send a command to the daemon listening on socket_path, returning the result."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        request = {"command": command, "arguments": arguments}
+        s.sendall(json.dumps(request).encode() + b"\n")
+        with s.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise DaemonError("The daemon closed the connection without responding.")
+    try:
+        response = json.loads(line)
+    except ValueError as e:
+        raise DaemonError(f"Bad response from the daemon: {e}")
+    if not response["ok"]:
+        raise DaemonError(response["error"])
+    return response["result"]
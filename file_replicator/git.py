@@ -0,0 +1,166 @@
+import os
+import subprocess
+import threading
+
+__all__ = [
+    "GitIgnoreChecker",
+    "git_submodules",
+    "is_git_work_tree",
+    "iter_git_files",
+    "iter_git_ignored",
+]
+
+
+class GitError(Exception):
+    pass
+
+
+def is_git_work_tree(src_dir):
+    """Return whether src_dir is in a git work tree (and git is available)."""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--is-inside-work-tree"],
+            cwd=src_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    return result.returncode == 0 and result.stdout.strip() == "true"
+
+
+def _ls_files(src_dir, *options):
+    """Yield the paths (relative to src_dir) given by git ls-files with the options."""
+    p = subprocess.Popen(
+        ["git", "ls-files", "-z", *options],
+        cwd=src_dir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    with p:
+        remainder = b""
+        for chunk in iter(lambda: p.stdout.read(64 * 1024), b""):
+            *paths, remainder = (remainder + chunk).split(b"\0")
+            for path in paths:
+                yield os.fsdecode(path)
+        stderr = p.stderr.read()
+    if p.returncode:
+        raise GitError(f"git ls-files failed: {stderr.decode().strip()}")
+
+
+def git_submodules(src_dir, subtree="."):
+    """Return the set of paths (relative to src_dir) of the submodules in the subtree.
+
+    These are "gitlinks" in git's index.
+    """
+    return {
+        entry.split("\t", 1)[1]
+        for entry in _ls_files(src_dir, "--stage", "--", f":(literal){subtree}")
+        if entry.startswith("160000 ")
+    }
+
+
+def iter_git_files(src_dir, modified_only=False, subtree="."):
+    """Yield paths (relative to src_dir) of the files git has in the work tree.
+
+    These are the tracked files plus untracked files not ignored by git (taking into
+    account all .gitignore files, .git/info/exclude and the global excludes file).
+
+    With modified_only, just yield the untracked files and those git's index (and so
+    its stat cache) shows to have been modified. Only files in the subtree (relative to
+    src_dir) are listed. Submodules are left out, as they are repositories of their own.
+    """
+    pathspec = ["--", f":(literal){subtree}"]
+    left_out = set(_ls_files(src_dir, "--deleted", *pathspec))
+    left_out.update(git_submodules(src_dir, subtree))
+    if modified_only:
+        options = ["--modified", "--others", "--exclude-standard"]
+    else:
+        options = ["--cached", "--others", "--exclude-standard"]
+    for path in _ls_files(src_dir, *options, *pathspec):
+        if path not in left_out:
+            yield path
+
+
+def iter_git_ignored(src_dir):
+    """Yield paths (relative to src_dir) of the files and directories git ignores.
+
+    Directories are given (ending with "/") rather than the files in them.
+    """
+    return _ls_files(
+        src_dir, "--others", "--ignored", "--exclude-standard", "--directory"
+    )
+
+
+class GitIgnoreChecker:
+    """Check whether paths in src_dir are ignored, following all of git's ignore rules.
+
+    This has the match_file() method of a pathspec.PathSpec, so can be used in place of
+    one. A single git check-ignore process answers every check, so it is quick enough
+    for each file system event. Anything in a .git directory or a submodule is taken
+    to be ignored, as iter_git_files() doesn't list it either. It is safe to use from
+    several threads.
+    """
+
+    def __init__(self, src_dir):
+        self.src_dir = os.path.abspath(src_dir)
+        self.submodules = git_submodules(self.src_dir)
+        self.process = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        self.process = subprocess.Popen(
+            ["git", "check-ignore", "--stdin", "-z", "--non-matching", "--verbose"],
+            cwd=self.src_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def _read_field(self):
+        field = bytearray()
+        while True:
+            c = self.process.stdout.read(1)
+            if not c:
+                raise GitError("git check-ignore stopped")
+            if c == b"\0":
+                return bytes(field)
+            field += c
+
+    def match_file(self, path):
+        """Return whether the path (absolute, or relative to src_dir) is ignored."""
+        path = os.path.relpath(os.path.join(self.src_dir, path), self.src_dir)
+        parts = path.split(os.sep)
+        if parts[0] == os.pardir:
+            return False
+        if ".git" in parts:
+            return True
+        for i in range(1, len(parts) + 1):
+            if os.path.join(*parts[:i]) in self.submodules:
+                return True
+        with self.lock:
+            # If git stops, start it again for the next path.
+            try:
+                if self.process is None:
+                    self._start()
+                self.process.stdin.write(os.fsencode(path) + b"\0")
+                self.process.stdin.flush()
+                source, _, pattern, _ = [self._read_field() for _ in range(4)]
+            except (OSError, GitError):
+                self._stop()
+                return False
+        # A matching negated pattern (e.g. "!keep.log") means the path isn't ignored.
+        return bool(source) and not pattern.startswith(b"!")
+
+    def _stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+            self.process = None
+
+    def close(self):
+        with self.lock:
+            self._stop()
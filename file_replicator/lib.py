@@ -1,6 +1,14 @@
+import collections
 import contextlib
+import itertools
+import os
 import os.path
+import queue
+import shlex
+import stat
 import subprocess
+import tempfile
+import threading
 import time
 
 import pathspec
@@ -8,11 +16,21 @@ from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 from watchdog.utils import has_attribute, unicode_paths
 
-__all__ = ["make_file_replicator", "replicate_all_files", "replicate_files_on_change"]
+from .git import GitIgnoreChecker, is_git_work_tree, iter_git_files
+from .state import CONTENT, METADATA, FileStateStore
+from .tar_adapter import FILES_FROM
+
+__all__ = [
+    "Destination",
+    "make_file_replicator",
+    "replicate_all_files",
+    "replicate_files_on_change",
+]
 
 
 # Small receiver code (written in bash for minimum dependencies) which repeatadly reads
-# tar files from stdin and extracts them.
+# commands from stdin. Each is either "tar" followed by a tar file to extract, or "meta"
+# followed by (NUL separated) mode, mtime and path triples to set, ending with a NUL.
 # Note that this requires the full tar command, not the busybox "lightweight" version.
 RECEIVER_CODE = """
 set -e
@@ -21,10 +39,159 @@ if {clean_out_first}; then
 fi
 mkdir -p {dest_dir}
 cd {dest_dir}
-while true; do
-    {receiver_tar}
+while IFS= read -r command; do
+    case "$command" in
+        tar)
+            {receiver_tar}
+            ;;
+        meta)
+            while IFS= read -r -d '' mode && [ -n "$mode" ]; do
+                IFS= read -r -d '' mtime
+                IFS= read -r -d '' path
+                chmod "$mode" -- "$path" || true
+                touch -m -d "@$mtime" -- "$path" || true
+            done
+            ;;
+    esac
 done 2>/dev/null
 """
+TAR_COMMAND = b"tar\n"
+METADATA_COMMAND = b"meta\n"
+
+# Maximum number of files named on one tar command line when copying in bulk.
+BULK_CHUNK_SIZE = 500
+
+
+Destination = collections.namedtuple(
+    "Destination", ["remote_tar", "dest_parent_dir", "connection_command"]
+)
+
+# Amount of encoded data allowed to queue up for a slow destination (within an archive)
+# before reading more (and so sending to all the other destinations) waits for it.
+DESTINATION_BACKLOG_LIMIT = 64 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class DestinationWriter:
+    """Write to the stdin of a process from a thread of its own.
+
+    Data is queued so that one slow destination doesn't hold up the others, until its
+    backlog reaches DESTINATION_BACKLOG_LIMIT bytes. drain() waits for the backlog to
+    be written.
+
+    If writing fails, the error is kept (and raised by close()) and anything more
+    written is dropped, so the other destinations carry on.
+    """
+
+    FLUSH = b""
+
+    def __init__(self, process, name):
+        self.process = process
+        self.name = name
+        self.chunks = collections.deque()
+        self.backlog = 0
+        self.unwritten = 0
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        with self.condition:
+            while self.backlog > DESTINATION_BACKLOG_LIMIT and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                return
+            self.chunks.append(data)
+            self.backlog += len(data)
+            self.unwritten += 1
+            self.condition.notify_all()
+
+    def flush(self):
+        self.write(self.FLUSH)
+
+    def drain(self):
+        """Wait until everything written so far is written to the process (or fails)."""
+        with self.condition:
+            while self.unwritten and self.error is None:
+                self.condition.wait()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.chunks and not self.closed:
+                    self.condition.wait()
+                if not self.chunks:
+                    return
+                data = self.chunks.popleft()
+            try:
+                if data is self.FLUSH:
+                    self.process.stdin.flush()
+                else:
+                    self.process.stdin.write(data)
+            except OSError as e:
+                print(f"Stopped replicating to {self.name}: {e}")
+                with self.condition:
+                    self.error = e
+                    self.chunks.clear()
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.backlog -= len(data)
+                self.unwritten -= 1
+                self.condition.notify_all()
+
+
+def chunk_for_sender(local_tar, rel_src_filenames):
+    """Split the files into lists to send in one archive each.
+
+    A tar which reads file names from stdin can take any number of them, otherwise they
+    are given on the command line BULK_CHUNK_SIZE at a time.
+    """
+    if FILES_FROM in local_tar.capabilities:
+        chunk_size = len(rel_src_filenames) or 1
+    else:
+        chunk_size = BULK_CHUNK_SIZE
+    for i in range(0, len(rel_src_filenames), chunk_size):
+        yield rel_src_filenames[i : i + chunk_size]
+
+
+@contextlib.contextmanager
+def sender_args(local_tar, rel_src_filenames):
+    """Yield the sender tar command for the files, and a file to give as its stdin.
+
+    The file holds the NUL separated file names if the tar can read them from stdin,
+    otherwise it is None and the names are in the command (made not to look like
+    options).
+    """
+    if FILES_FROM not in local_tar.capabilities:
+        rel_src_filenames = [
+            os.path.join(".", f) if f.startswith("-") else f for f in rel_src_filenames
+        ]
+        yield local_tar.sender_cmd(*rel_src_filenames), None
+        return
+    with tempfile.TemporaryFile() as names:
+        names.write(b"".join(os.fsencode(f) + b"\0" for f in rel_src_filenames))
+        names.seek(0)
+        yield local_tar.sender_files_from_cmd(), names
+
+
+def raise_on_sender_error(stderr):
+    if stderr:
+        if "No such file or directory" in stderr.decode():
+            # Ignore because file was removed before we had a chance to copy it.
+            pass
+        else:
+            raise RuntimeError(f"ERROR: {stderr.decode()}")
 
 
 @contextlib.contextmanager
@@ -36,55 +203,199 @@ def make_file_replicator(
     bash_connection_command,
     clean_out_first=False,
     debugging=False,
+    extra_destinations=(),
 ):
-    """Yield a copy_file(<filename>) function for replicating files over a "bash connection".
+    """Yield a copy_file(<filename>, ...) function for replicating files over a "bash connection".
 
-    The <filename> must be in the given <src_dir>. The final path in the <src_dir>
-    becomes the destination directory in the <dest_parent_dir>.
+    Each <filename> must be in the given <src_dir>. The final path in the <src_dir>
+    becomes the destination directory in the <dest_parent_dir>. Several filenames
+    given together are sent in as few tar archives as possible.
+
+    The copy_file function has an update_metadata(<filename>, ...) attribute, which
+    sends just the mode and modification time of files rather than their content, and
+    a copy_file_throttled(<throttle>, <filename>, ...) attribute, which calls
+    <throttle>(<number of bytes>) before sending each chunk of data.
 
     The <bash_connection_command> must be a list.
 
+    Files can be replicated to more destinations at the same time by giving
+    <extra_destinations> as a list of Destination tuples. Each file is then read (and
+    turned into a tar archive) just once, with the result written to every destination.
+    If one destination fails the others carry on, and the failure is raised on exit.
+
     """
     src_dir = os.path.abspath(src_dir)
-    dest_parent_dir = os.path.abspath(dest_parent_dir)
-    dest_dir = os.path.join(dest_parent_dir, os.path.basename(src_dir))
+    destinations = [
+        Destination(remote_tar, dest_parent_dir, bash_connection_command),
+        *extra_destinations,
+    ]
+    local_tar = local_tar.negotiate(*(d.remote_tar for d in destinations))
+    if debugging:
+        print(f"Sending with {local_tar} using {sorted(local_tar.capabilities)}")
 
-    p = subprocess.Popen(bash_connection_command, stdin=subprocess.PIPE)
+    processes = []
+    for destination in destinations:
+        dest_parent_dir = os.path.abspath(destination.dest_parent_dir)
+        dest_dir = os.path.join(dest_parent_dir, os.path.basename(src_dir))
 
-    # Get the remote end up and running waiting for tar files.
-    receiver_code = RECEIVER_CODE.format(
-        dest_dir=dest_dir,
-        clean_out_first=str(clean_out_first).lower(),
-        receiver_tar=remote_tar.receiver_cmd_str(),
-    )
-    p.stdin.write(receiver_code.encode())
-    p.stdin.flush()
+        p = subprocess.Popen(destination.connection_command, stdin=subprocess.PIPE)
+        processes.append(p)
 
-    def copy_file(src_filename):
-        src_filename = os.path.abspath(src_filename)
-        rel_src_filename = os.path.relpath(src_filename, src_dir)
-        if debugging:
-            print(f"Sending {src_filename}...")
-        result = subprocess.run(
-            local_tar.sender_cmd(rel_src_filename),
-            cwd=src_dir,
-            check=True,
-            stdout=p.stdin,
-            stderr=subprocess.PIPE,
+        # Get the remote end up and running waiting for tar files.
+        receiver_code = RECEIVER_CODE.format(
+            dest_dir=dest_dir,
+            clean_out_first=str(clean_out_first).lower(),
+            receiver_tar=destination.remote_tar.receiver_cmd_str(),
         )
-        if result.stderr:
-            if "No such file or directory" in result.stderr.decode():
-                # Ignore because file was removed before we had a chance to copy it.
-                pass
-            else:
-                raise RuntimeError(f"ERROR: {result.stderr.decode()}")
+        p.stdin.write(receiver_code.encode())
         p.stdin.flush()
 
+    if len(processes) > 1:
+        writers = [
+            DestinationWriter(p, " ".join(map(shlex.quote, d.connection_command)))
+            for p, d in zip(processes, destinations)
+        ]
+    else:
+        writers = []
+
+    def live_writers():
+        """Return the writers of the destinations which haven't failed."""
+        live = [w for w in writers if w.error is None]
+        if not live:
+            raise writers[0].error
+        return live
+
+    def drain_writers():
+        """Wait for every destination to take what has been written, so that sending
+        takes as long as the slowest connection does, not as long as queueing."""
+        for writer in live_writers():
+            writer.drain()
+        live_writers()  # raising if every destination has now failed
+
+    def write_message(data):
+        if writers:
+            for writer in live_writers():
+                writer.write(data)
+                writer.flush()
+            drain_writers()
+        else:
+            processes[0].stdin.write(data)
+            processes[0].stdin.flush()
+
+    def write_chunk(data):
+        if writers:
+            for writer in live_writers():
+                writer.write(data)
+        else:
+            processes[0].stdin.write(data)
+
+    def send_archive(rel_src_filenames, throttle=None):
+        with sender_args(local_tar, rel_src_filenames) as (sender_cmd, names):
+            if not writers and throttle is None:
+                # Just one destination, so tar can write straight to it.
+                p = processes[0]
+                write_message(TAR_COMMAND)
+                result = subprocess.run(
+                    sender_cmd,
+                    cwd=src_dir,
+                    check=True,
+                    stdin=names,
+                    stdout=p.stdin,
+                    stderr=subprocess.PIPE,
+                )
+                raise_on_sender_error(result.stderr)
+                p.stdin.flush()
+                return
+            write_chunk(TAR_COMMAND)
+            pump_archive(sender_cmd, names, throttle)
+
+    def pump_archive(sender_cmd, names, throttle):
+        """Read the archive from the sender tar and write it to every destination,
+        calling throttle(<number of bytes>) (if given) before writing each chunk."""
+        with tempfile.TemporaryFile() as stderr:
+            sender = subprocess.Popen(
+                sender_cmd,
+                cwd=src_dir,
+                stdin=names,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+            )
+            with sender:
+                for chunk in iter(lambda: sender.stdout.read(READ_CHUNK_SIZE), b""):
+                    if throttle is not None:
+                        throttle(len(chunk))
+                    write_chunk(chunk)
+            if sender.returncode:
+                raise subprocess.CalledProcessError(sender.returncode, sender.args)
+            stderr.seek(0)
+            raise_on_sender_error(stderr.read())
+        if writers:
+            for writer in live_writers():
+                writer.flush()
+            drain_writers()
+        else:
+            processes[0].stdin.flush()
+
+    def copy_file_throttled(throttle, *src_filenames):
+        """Copy the files as copy_file() does, calling throttle(<number of bytes>)
+        before sending each chunk of data, e.g. to limit the rate of sending."""
+        src_filenames = [os.path.abspath(f) for f in src_filenames]
+        rel_src_filenames = [os.path.relpath(f, src_dir) for f in src_filenames]
+        if debugging:
+            if len(src_filenames) == 1:
+                print(f"Sending {src_filenames[0]}...")
+            else:
+                print(f"Sending {len(src_filenames)} files in bulk...")
+        for chunk in chunk_for_sender(local_tar, rel_src_filenames):
+            send_archive(chunk, throttle)
+
+    def copy_file(*src_filenames):
+        copy_file_throttled(None, *src_filenames)
+
+    def update_metadata(*src_filenames):
+        """Send just the mode and mtime of the (regular) files, not their content."""
+        records = []
+        for src_filename in src_filenames:
+            try:
+                st = os.lstat(src_filename)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            seconds, nanoseconds = divmod(st.st_mtime_ns, 1000000000)
+            rel_src_filename = os.path.relpath(os.path.abspath(src_filename), src_dir)
+            records.append(
+                f"{stat.S_IMODE(st.st_mode):o}\0{seconds}.{nanoseconds:09d}\0".encode()
+                + os.fsencode(rel_src_filename)
+                + b"\0"
+            )
+        if debugging:
+            print(f"Sending metadata of {len(records)} files...")
+        if records:
+            write_message(METADATA_COMMAND + b"".join(records) + b"\0")
+
+    # Callers which know only the metadata of a file has changed can use this instead.
+    copy_file.update_metadata = update_metadata
+    # Callers which need to limit the rate of sending can use this instead.
+    copy_file.copy_file_throttled = copy_file_throttled
+
     try:
         yield copy_file
     finally:
-        p.stdin.close()
-        p.wait()
+        failures = []
+        for writer in writers:
+            try:
+                writer.close()
+            except OSError as e:
+                failures.append(f"{writer.name}: {e}")
+        for p in processes:
+            try:
+                p.stdin.close()
+            except OSError:
+                pass
+            p.wait()
+        if failures:
+            raise RuntimeError(f"Replicating failed to {'; '.join(failures)}")
 
 
 def get_pathspec(src_dir, use_gitignore=True):
@@ -97,58 +408,715 @@ def get_pathspec(src_dir, use_gitignore=True):
     return spec
 
 
-def replicate_all_files(src_dir, copy_file, use_gitignore=True, debugging=False):
-    """Walk src_dir to copy all files using copy_file()."""
+def get_ignore_spec(src_dir, use_gitignore=True, use_git=True):
+    """Return a spec whose match_file(path) says whether a path in src_dir is ignored.
+
+    This follows the same rules as iter_files_to_replicate(). If it is a
+    GitIgnoreChecker, close it when done.
+    """
+    if use_gitignore and use_git and is_git_work_tree(src_dir):
+        return GitIgnoreChecker(src_dir)
+    return get_pathspec(src_dir, use_gitignore)
+
+
+def iter_files_to_replicate(
+    src_dir,
+    use_gitignore=True,
+    use_git=True,
+    only_git_changes=False,
+    debugging=False,
+    subtree=".",
+):
+    """Yield the path of every file in src_dir to replicate.
+
+    If using gitignore and src_dir is in a git work tree, then git is asked for its
+    files (which is faster, and follows all of git's ignore rules). Otherwise src_dir
+    is walked, filtering files with its .gitignore (if using gitignore).
+
+    With only_git_changes, just the files git sees as modified or untracked are given.
+    Only files in the subtree (a file or directory relative to src_dir) are listed.
+    """
+    if use_gitignore and use_git and is_git_work_tree(src_dir):
+        if debugging:
+            print("Listing files using git")
+        for filename in iter_git_files(
+            src_dir, modified_only=only_git_changes, subtree=subtree
+        ):
+            yield os.path.join(src_dir, filename)
+        return
+    if debugging and only_git_changes:
+        print("Not using git, so replicating all files instead of just changes")
     spec = get_pathspec(src_dir, use_gitignore)
-    for filename in pathspec.util.iter_tree(src_dir):
-        if not spec.match_file(filename):
-            copy_file(os.path.join(src_dir, filename))
+    top = os.path.join(src_dir, subtree)
+    if os.path.isdir(top) and not os.path.islink(top):
+        paths = (os.path.join(subtree, f) for f in pathspec.util.iter_tree(top))
+    else:
+        paths = [subtree] if os.path.lexists(top) else []
+    for path in map(os.path.normpath, paths):
+        if not spec.match_file(path):
+            yield os.path.join(src_dir, path)
+
+
+def replicate_all_files(
+    src_dir,
+    copy_file,
+    use_gitignore=True,
+    debugging=False,
+    known_state=None,
+    use_git=True,
+    only_git_changes=False,
+):
+    """Copy all files in src_dir (see iter_files_to_replicate()) using copy_file().
+
+    If a known_state FileStateStore is given, it records the state (including the
+    digest) of each file sent. Files it already knows to be unchanged are not sent.
+    """
+    for filename in iter_files_to_replicate(
+        src_dir, use_gitignore, use_git, only_git_changes, debugging
+    ):
+        if known_state is None:
+            copy_file(filename)
+            continue
+        if known_state.is_unchanged(filename):
+            continue
+        with recording_before_sending(known_state, [filename]):
+            copy_file(filename)
+
+
+@contextlib.contextmanager
+def recording_before_sending(known_state, filenames, metadata_only=False, digests=None):
+    """Record the state of the (non-directory) files, then send them in the context.
+
+    Recording first means a change made while the files are being sent differs from
+    what is recorded, and so is sent too. If sending fails, the files are forgotten.
+    Nothing is recorded if the known_state is None. Digests already worked out are
+    reused (see FileStateStore.record_content()).
+    """
+    if known_state is None:
+        yield
+        return
+    filenames = [os.path.abspath(f) for f in filenames if not os.path.isdir(f)]
+    for filename in filenames:
+        if metadata_only:
+            known_state.record_metadata(filename)
+        else:
+            known_state.record_content(filename, digests)
+    try:
+        yield
+    except BaseException:
+        for filename in filenames:
+            known_state.discard(filename)
+        raise
+
+
+def collapse_subtrees(directories):
+    """Return the given directories without any that are inside another one."""
+    roots = []
+    for directory in sorted(directories):
+        if not roots or os.path.commonpath([roots[-1], directory]) != roots[-1]:
+            roots.append(directory)
+    return roots
+
+
+# Event rate (over a one second window) above which changes are no longer copied one
+# at a time. Instead the affected directories are rescanned once the storm has settled.
+STORM_EVENTS_PER_SECOND = 100
+STORM_SETTLE_SECONDS = 1.0
 
 
 class CopyFileEventHandler(FileSystemEventHandler):
-    """A watchdog.FileSystemEventHandler that copies files using copy_file()."""
+    """A watchdog.FileSystemEventHandler that copies files using copy_file().
+
+    Bursts of events (e.g. from a git checkout) are detected and, rather than copying
+    each file as its event arrives, the directories involved are marked dirty. Once the
+    burst is over, flush_storm() rescans them and copies whatever differs from the
+    known_state in one bulk copy_file() call.
 
-    def __init__(self, copy_file, debugging=False):
+    Changes are classified against the known_state, so that files which haven't
+    changed are not sent again, and files whose content is unchanged but whose mode or
+    mtime has changed (e.g. from chmod or touch) are sent with update_metadata()
+    instead of copy_file() (if given).
+
+    If a (started) SendScheduler is given, changes are sent through it instead (so
+    copy_file and update_metadata can be None), and it records their state in its
+    known_state as they are actually sent.
+    """
+
+    def __init__(
+        self,
+        copy_file,
+        debugging=False,
+        storm_threshold=STORM_EVENTS_PER_SECOND,
+        storm_settle=STORM_SETTLE_SECONDS,
+        known_state=None,
+        update_metadata=None,
+        scheduler=None,
+    ):
         self.copy_file = copy_file
+        self.update_metadata = update_metadata
+        self.scheduler = scheduler
+        if scheduler is not None:
+            self.copy_file = scheduler.copy_file_urgently
+            self.update_metadata = None
+            if scheduler.update_metadata is not None:
+                self.update_metadata = scheduler.update_metadata_urgently
+            known_state = scheduler.known_state
         self.debugging = debugging
         self.last_event_timestamp = time.time()
+        self.storm_threshold = storm_threshold
+        self.storm_settle = storm_settle
+        self.known_state = FileStateStore() if known_state is None else known_state
+        self.recent_event_timestamps = collections.deque()
+        self.dirty_dirs = set()
+        self.lock = threading.Lock()
+
+    def ignores(self, path):
+        return False
 
     def on_any_event(self, event):
-        self.last_event_timestamp = time.time()
+        now = time.time()
         if self.debugging:
             print(f"Detected change: {event.key}")
 
-        if event.event_type == "deleted":
-            return
-        if event.is_directory and event.event_type == "modified":
+        with self.lock:
+            self.last_event_timestamp = now
+            in_storm = self._note_event_for_storm(now)
+            if event.event_type == "deleted":
+                return
+            if event.is_directory and event.event_type == "modified":
+                return
+            if event.event_type == "moved":
+                path = event.dest_path
+            else:
+                path = event.src_path
+            if in_storm:
+                self.dirty_dirs.add(
+                    path if event.is_directory else os.path.dirname(path)
+                )
+                return
+        self.send(path)
+
+    def _note_event_for_storm(self, now):
+        """Record an event and return whether we are (now) in an event storm."""
+        timestamps = self.recent_event_timestamps
+        timestamps.append(now)
+        while timestamps and now - timestamps[0] > 1.0:
+            timestamps.popleft()
+        if self.dirty_dirs:
+            return True
+        if self.storm_threshold and len(timestamps) > self.storm_threshold:
+            if self.debugging:
+                print("Event storm detected: deferring changes until it settles")
+            return True
+        return False
+
+    def send(self, *paths, in_bulk=False):
+        """Send the content or just the metadata of the paths, as needed.
+
+        Changes in bulk are sent through the scheduler (if any) with BULK priority.
+        """
+        contents = []
+        metadata = []
+        digests = {}
+        for path in map(os.path.abspath, paths):
+            if os.path.isdir(path):
+                contents.append(path)
+                continue
+            change = self.known_state.classify_change(path, digests)
+            if change == CONTENT or (change == METADATA and not self.update_metadata):
+                contents.append(path)
+            elif change == METADATA:
+                metadata.append(path)
+            elif self.debugging:
+                print(f"Not sending unchanged {path}")
+        if self.scheduler is not None:
+            # The scheduler records the state itself, once the files are actually sent.
+            priority = BULK if in_bulk else URGENT
+            if contents:
+                self.scheduler.copy_file_urgently(
+                    *contents, digests=digests, priority=priority
+                )
+            if metadata:
+                self.scheduler.update_metadata_urgently(*metadata, priority=priority)
             return
-        if event.event_type == "moved":
-            self.copy_file(event.dest_path)
-        else:
-            self.copy_file(event.src_path)
+        if contents:
+            with recording_before_sending(self.known_state, contents, digests=digests):
+                self.copy_file(*contents)
+        if metadata:
+            with recording_before_sending(
+                self.known_state, metadata, metadata_only=True
+            ):
+                self.update_metadata(*metadata)
+
+    def flush_storm(self, force=False):
+        """Copy files changed during an event storm, if it has settled (or if forced)."""
+        with self.lock:
+            if not self.dirty_dirs:
+                return
+            if (
+                not force
+                and time.time() - self.last_event_timestamp < self.storm_settle
+            ):
+                return
+            dirty_dirs, self.dirty_dirs = self.dirty_dirs, set()
+            self.recent_event_timestamps.clear()
+        changed = list(self.iter_changed_files(collapse_subtrees(dirty_dirs)))
+        if self.debugging:
+            print(f"Event storm settled: {len(changed)} changed files to send")
+        if changed:
+            self.send(*changed, in_bulk=True)
+
+    def iter_changed_files(self, directories):
+        """Yield files below the directories which differ from the known_state."""
+        for directory in directories:
+            for dirpath, dirnames, filenames in os.walk(directory):
+                dirnames[:] = [
+                    d for d in dirnames if not self.ignores(os.path.join(dirpath, d))
+                ]
+                for filename in filenames:
+                    path = os.path.abspath(os.path.join(dirpath, filename))
+                    if self.ignores(path):
+                        continue
+                    if not self.known_state.is_unchanged(path):
+                        yield path
 
 
 class GitIgnoreCopyFileEventHandler(CopyFileEventHandler):
-    def __init__(self, copy_file, ignore_spec, debugging=False):
-        super().__init__(copy_file, debugging)
+    def __init__(self, copy_file, ignore_spec, debugging=False, **kwargs):
+        super().__init__(copy_file, debugging, **kwargs)
         self.spec = ignore_spec
 
+    def ignores(self, path):
+        return self.spec.match_file(unicode_paths.decode(path))
+
     def dispatch(self, event):
-        if event.src_path and self.spec.match_file(
-            unicode_paths.decode(event.src_path)
-        ):
+        if event.src_path and self.ignores(event.src_path):
             if self.debugging:
                 print(f"Ignoring source change on {event.src_path}")
             return
-        if has_attribute(event, "dest_path") and self.spec.match_file(
-            unicode_paths.decode(event.dest_path)
-        ):
+        if has_attribute(event, "dest_path") and self.ignores(event.dest_path):
             if self.debugging:
                 print(f"Ignoring destination change on {event.dest_path}")
             return
         super().dispatch(event)
 
 
+class SchedulerClosed(Exception):
+    pass
+
+
+# Lanes of work for a SendScheduler, in order of priority. Changes to files up to
+# INTERACTIVE_SIZE_LIMIT bytes (e.g. just saved in an editor) are URGENT, and bigger
+# ones BULK, as are changes made in bulk (e.g. by a git checkout, or a resync), ahead
+# of BACKGROUND work. BULK and BACKGROUND work can be rate limited.
+URGENT = 0
+BULK = 1
+BACKGROUND = 2
+
+INTERACTIVE_SIZE_LIMIT = 1024 * 1024
+
+# Maximum number of background copies waiting to be sent, so that a long walk of the
+# source tree doesn't race ahead of what has actually been sent.
+BACKGROUND_QUEUE_LIMIT = 1000
+
+# Rate limit for BULK and BACKGROUND work that follows the measured throughput.
+AUTO_RATE = "auto"
+AUTO_RATE_FRACTION = 0.5
+
+
+class TokenBucket:
+    """Limit the rate of sending bytes, allowing bursts of up to a second's worth.
+
+    Sending is allowed whenever the bucket isn't in debt, and takes its bytes from the
+    bucket (going into debt if need be), so a send of any size can go ahead.
+    throttle() does both, so is given to copy_file_throttled() to limit each chunk.
+    """
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = rate
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Return how many seconds until sending is allowed."""
+        self._refill()
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def consume(self, nbytes):
+        self._refill()
+        self.tokens -= nbytes
+
+    def throttle(self, nbytes):
+        """Wait until sending is allowed, then take nbytes from the bucket."""
+        delay = self.delay()
+        while delay > 0:
+            self.sleep(delay)
+            delay = self.delay()
+        self.consume(nbytes)
+
+
+# Each file in a tar archive takes a header block and its content padded to whole
+# blocks, and each archive ends with two zero blocks.
+TAR_BLOCK_SIZE = 512
+TAR_END_OF_ARCHIVE_SIZE = 2 * TAR_BLOCK_SIZE
+
+
+def archive_size(filenames):
+    """Return (roughly) the size of a tar archive of the files."""
+    size = TAR_END_OF_ARCHIVE_SIZE
+    for filename in filenames:
+        try:
+            file_size = os.lstat(filename).st_size
+        except OSError:
+            file_size = 0
+        blocks = -(-file_size // TAR_BLOCK_SIZE)
+        size += (1 + blocks) * TAR_BLOCK_SIZE
+    return size
+
+
+# Queued copies are packed into one send of about as many bytes as can be sent in this
+# long, so that small files share archives (and flushes) when there is a backlog,
+# without holding anything back when there isn't.
+TARGET_FLUSH_SECONDS = 0.2
+INITIAL_BYTES_PER_SECOND = 1024 * 1024
+MIN_BATCH_BYTES = 64 * 1024
+MAX_BATCH_BYTES = 256 * 1024 * 1024
+
+
+class BatchSizer:
+    """Size batches of files to send from the throughput and latency measured so far.
+
+    Sends no bigger than MIN_BATCH_BYTES are taken to measure the latency (the fixed
+    cost of a send), and bigger ones the throughput once that latency is allowed for.
+    Both are exponentially weighted moving averages.
+    """
+
+    def __init__(self, target_seconds=TARGET_FLUSH_SECONDS, weight=0.3):
+        self.target_seconds = target_seconds
+        self.weight = weight
+        self.bytes_per_second = INITIAL_BYTES_PER_SECOND
+        self.latency = 0.0
+
+    def _average(self, average, value):
+        return (1 - self.weight) * average + self.weight * value
+
+    def record(self, nbytes, seconds):
+        """Record that a send of nbytes took this many seconds."""
+        if nbytes <= MIN_BATCH_BYTES:
+            self.latency = self._average(self.latency, seconds)
+            return
+        transfer_seconds = max(seconds - self.latency, 1e-3)
+        self.bytes_per_second = self._average(
+            self.bytes_per_second, nbytes / transfer_seconds
+        )
+
+    def batch_bytes(self):
+        """Return how many bytes to aim to send at once."""
+        nbytes = int(self.bytes_per_second * self.target_seconds)
+        return min(max(nbytes, MIN_BATCH_BYTES), MAX_BATCH_BYTES)
+
+
+class SendScheduler:
+    """Serialise copy_file() calls on a worker thread, sending urgent work first.
+
+    Background work (e.g. the initial replication) skips any file that has already
+    been sent urgently (e.g. because it was edited in the meantime). These files are
+    remembered until finish_background() is called and the background work is sent.
+
+    Work queued up behind a send is packed into batches sized by a BatchSizer, so many
+    small files are sent together while a single change is sent straight away.
+
+    Urgent copies of big files go in a BULK lane between urgent and background work.
+    The bulk_rate (bytes per second, or AUTO_RATE for a fraction of the throughput
+    measured) limits sending BULK and BACKGROUND work. The data itself is throttled
+    as it is sent, if copy_file has a copy_file_throttled() attribute (see
+    make_file_replicator()), otherwise each send waits for the rate to allow it. URGENT
+    work can't interrupt an archive being sent, but goes ahead of the next.
+
+    Sending can be paused, in which case work queues up until resumed.
+
+    If a known_state FileStateStore is given, the state of files is recorded just
+    before they are sent (see recording_before_sending()), so files which are queued
+    but never sent (e.g. after sending fails) are not taken to have been sent.
+    """
+
+    def __init__(
+        self,
+        copy_file,
+        debugging=False,
+        target_flush_seconds=TARGET_FLUSH_SECONDS,
+        bulk_rate=None,
+        known_state=None,
+    ):
+        self.copy_file = copy_file
+        self.known_state = known_state
+        # Digests worked out when classifying queued changes, to reuse when recording.
+        self.digests = {}
+        self.update_metadata = getattr(copy_file, "update_metadata", None)
+        self.copy_file_throttled = getattr(copy_file, "copy_file_throttled", None)
+        self.debugging = debugging
+        self.batch_sizer = BatchSizer(target_flush_seconds)
+        self.auto_rate = bulk_rate == AUTO_RATE
+        if self.auto_rate:
+            bulk_rate = self.batch_sizer.bytes_per_second * AUTO_RATE_FRACTION
+        self.bulk_bucket = None if bulk_rate is None else TokenBucket(bulk_rate)
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.sent_urgently = set()
+        self.background_slots = threading.BoundedSemaphore(BACKGROUND_QUEUE_LIMIT)
+        self.background_queued = 0
+        self.background_finished = False
+        self.background_lock = threading.Lock()
+        self.closed = False
+        self.discard_background = False
+        self.error = None
+        self.files_sent = 0
+        self.waiting = False
+        self.unpaused = threading.Event()
+        self.unpaused.set()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    @property
+    def paused(self):
+        return not self.unpaused.is_set()
+
+    def pause(self):
+        self.unpaused.clear()
+
+    def resume(self):
+        self.unpaused.set()
+
+    def pending(self):
+        """Return the (approximate) number of copies waiting to be sent."""
+        return self.queue.qsize() + self.waiting
+
+    @property
+    def bulk_rate(self):
+        return None if self.bulk_bucket is None else self.bulk_bucket.rate
+
+    def copy_file_urgently(self, *filenames, digests=None, priority=URGENT):
+        """Send the changed files ahead of background work.
+
+        Small files are URGENT, unless the priority is BULK (for changes made in bulk,
+        which shouldn't hold up interactive changes or go beyond the bulk rate).
+        """
+        filenames = [os.path.abspath(f) for f in filenames]
+        if digests and self.known_state is not None:
+            self.digests.update(digests)
+        with self.background_lock:
+            if not self.background_finished or self.background_queued:
+                self.sent_urgently.update(filenames)
+        lanes = {URGENT: [], BULK: []}
+        for filename in filenames:
+            try:
+                size = os.lstat(filename).st_size
+            except OSError:
+                size = 0
+            urgent = priority == URGENT and size <= INTERACTIVE_SIZE_LIMIT
+            lanes[URGENT if urgent else BULK].append(filename)
+        for priority, lane_filenames in lanes.items():
+            if lane_filenames:
+                self._submit(priority, lane_filenames)
+
+    def update_metadata_urgently(self, *filenames, priority=URGENT):
+        self._submit(priority, filenames, self.update_metadata)
+
+    def copy_file_in_background(self, *filenames):
+        filenames = [
+            f for f in map(os.path.abspath, filenames) if f not in self.sent_urgently
+        ]
+        if not filenames:
+            return
+        while not self.background_slots.acquire(timeout=0.1):
+            self._raise_if_closed()
+        with self.background_lock:
+            self.background_queued += 1
+        try:
+            self._submit(BACKGROUND, filenames)
+        except SchedulerClosed:
+            self._background_sent()
+            raise
+
+    def finish_background(self):
+        """Note that there is no more background work to come.
+
+        What has been sent urgently is then only remembered (to skip it) until the
+        background work already queued has been sent.
+        """
+        with self.background_lock:
+            self.background_finished = True
+            if not self.background_queued:
+                self.sent_urgently.clear()
+
+    def _background_sent(self):
+        with self.background_lock:
+            self.background_queued -= 1
+            if self.background_finished and not self.background_queued:
+                self.sent_urgently.clear()
+
+    def _raise_if_closed(self):
+        if self.error is not None:
+            raise SchedulerClosed(f"Sending failed: {self.error}")
+        if self.closed:
+            raise SchedulerClosed("The scheduler has been closed.")
+
+    def _submit(self, priority, filenames, send=None):
+        self._raise_if_closed()
+        self.queue.put((priority, next(self.sequence), filenames, send))
+
+    def _accept(self, priority, filenames):
+        """Return which of the dequeued filenames are still to be sent."""
+        if priority == BACKGROUND:
+            self.background_slots.release()
+            accepted = [f for f in filenames if f not in self.sent_urgently]
+            self._background_sent()
+            return [] if self.discard_background else accepted
+        return list(filenames)
+
+    def _pack(self, priority, filenames, send):
+        """Add queued work of the same kind to filenames, up to the batch size.
+
+        Return the filenames and their (approximate) archive size.
+        """
+        budget = self.batch_sizer.batch_bytes()
+        if self.bulk_bucket is not None and priority != URGENT:
+            # Keep rate limited sends short, so urgent work doesn't wait long.
+            budget = min(
+                budget, max(MIN_BATCH_BYTES, self.bulk_rate * TARGET_FLUSH_SECONDS)
+            )
+        packed = set(filenames)
+        size = archive_size(filenames)
+        while size < budget:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] != priority or item[2] is None or item[3] is not send:
+                self.queue.put(item)
+                break
+            more = self._accept(priority, item[2])
+            filenames.extend(f for f in more if f not in packed)
+            packed.update(more)
+            size += archive_size(more)
+        return filenames, size
+
+    def _urgent_work_queued(self):
+        with self.queue.mutex:
+            return bool(self.queue.queue) and self.queue.queue[0][0] == URGENT
+
+    def _wait_for_bulk_rate(self):
+        """Wait until the bulk rate allows sending, or return False if urgent work
+        has been queued meanwhile."""
+        while not self.discard_background:
+            delay = self.bulk_bucket.delay()
+            if delay <= 0:
+                break
+            if self._urgent_work_queued():
+                return False
+            time.sleep(min(delay, 0.05))
+        return True
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            priority, _, filenames, send = item
+            self.waiting = filenames is not None
+            self.unpaused.wait()
+            self.waiting = False
+            if filenames is None:
+                return
+            limited = self.bulk_bucket is not None and priority != URGENT
+            if limited and not self._wait_for_bulk_rate():
+                self.queue.put(item)
+                continue
+            filenames, size = self._pack(
+                priority, self._accept(priority, filenames), send
+            )
+            if not filenames:
+                continue
+            if self.debugging and len(filenames) > 1:
+                print(f"Packed {len(filenames)} files (about {size} bytes) to send")
+            start = time.monotonic()
+            throttled_seconds = 0.0
+
+            def throttle(nbytes):
+                nonlocal throttled_seconds
+                throttle_start = time.monotonic()
+                self.bulk_bucket.throttle(nbytes)
+                throttled_seconds += time.monotonic() - throttle_start
+
+            metadata_only = send is not None and send is self.update_metadata
+            try:
+                with recording_before_sending(
+                    self.known_state, filenames, metadata_only, self.digests
+                ):
+                    if send is None and limited and self.copy_file_throttled:
+                        self.copy_file_throttled(throttle, *filenames)
+                    else:
+                        (send or self.copy_file)(*filenames)
+            except Exception as e:
+                self.error = e
+                return
+            finally:
+                for filename in filenames:
+                    self.digests.pop(filename, None)
+            if send is None:
+                self.batch_sizer.record(
+                    size, time.monotonic() - start - throttled_seconds
+                )
+                if limited and not self.copy_file_throttled:
+                    # Not throttled as it was sent, so wait before the next send.
+                    self.bulk_bucket.consume(size)
+                if self.auto_rate:
+                    self.bulk_bucket.rate = (
+                        self.batch_sizer.bytes_per_second * AUTO_RATE_FRACTION
+                    )
+            self.files_sent += len(filenames)
+
+    def close(self, discard_background=False):
+        """Stop accepting work, send what is queued and wait for the worker to finish.
+
+        Any error from sending is re-raised here.
+        """
+        self.closed = True
+        self.discard_background = discard_background
+        self.resume()
+        self.queue.put((BACKGROUND + 1, next(self.sequence), None, None))
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
+
+
+def _replicate_all_files_in_background(src_dir, scheduler, stopping, **kwargs):
+    known_state = scheduler.known_state
+
+    def copy_file(*filenames):
+        if stopping.is_set():
+            raise SchedulerClosed("Stopped replicating all files.")
+        if known_state is not None:
+            # The scheduler records the state of the files as it sends them.
+            filenames = [f for f in filenames if not known_state.is_unchanged(f)]
+        if filenames:
+            scheduler.copy_file_in_background(*filenames)
+
+    try:
+        replicate_all_files(src_dir, copy_file, **kwargs)
+    except SchedulerClosed:
+        pass
+    finally:
+        scheduler.finish_background()
+
+
 class NoChangeTimeout(Exception):
     pass
 
@@ -174,20 +1142,53 @@ def replicate_files_on_change(
     debugging=False,
     observer_up_event=None,
     terminate_event=None,
+    storm_threshold=STORM_EVENTS_PER_SECOND,
+    known_state=None,
+    initial_replication=False,
+    use_git=True,
+    only_git_changes=False,
+    scheduler=None,
+    bulk_rate=None,
 ):
     """Wait for changes to files in src_dir and copy with copy_file().
 
     If provided, the timeout indicates when to return after that many seconds of no change.
+
+    With initial_replication, all files are also copied (as replicate_all_files()) in
+    the background once the watcher is running. Changed files are sent ahead of this
+    background work, and are not sent again by it.
+    The use_git and only_git_changes options are as for replicate_all_files(), and
+    changes are ignored following the same rules (see get_ignore_spec()).
+
+    Copies are sent by a SendScheduler, which can be given (already started, in which
+    case it is left running and copy_file, bulk_rate and known_state are not used). The
+    bulk_rate limits sending big files and the initial replication (see SendScheduler).
+
+    The storm_threshold is the rate of events per second above which changes are sent in
+    bulk once things settle (or None to always send each change as it happens). The
+    known_state is a FileStateStore (as updated by replicate_all_files()) and avoids
+    resending unchanged files. The scheduler records in it what it actually sends.
     """
     print("debug: replicate on change start")
     src_dir = os.path.abspath(src_dir)
-    if use_gitignore:
-        spec = get_pathspec(src_dir, use_gitignore)
-        event_handler = GitIgnoreCopyFileEventHandler(
-            copy_file, spec, debugging=debugging
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = SendScheduler(
+            copy_file,
+            debugging=debugging,
+            bulk_rate=bulk_rate,
+            known_state=FileStateStore() if known_state is None else known_state,
         )
+        scheduler.start()
+    handler_kwargs = dict(
+        debugging=debugging, storm_threshold=storm_threshold, scheduler=scheduler
+    )
+    spec = None
+    if use_gitignore:
+        spec = get_ignore_spec(src_dir, use_gitignore, use_git)
+        event_handler = GitIgnoreCopyFileEventHandler(None, spec, **handler_kwargs)
     else:
-        event_handler = CopyFileEventHandler(copy_file, debugging=debugging)
+        event_handler = CopyFileEventHandler(None, **handler_kwargs)
     observer = Observer()
     observer.schedule(event_handler, src_dir, recursive=True)
     if debugging:
@@ -200,14 +1201,37 @@ def replicate_files_on_change(
         time.sleep(0.5)
         observer_up_event.set()
         print("notified observer up")
+    walker = None
+    stopping = threading.Event()
+    if initial_replication:
+        walker = threading.Thread(
+            target=_replicate_all_files_in_background,
+            args=(src_dir, scheduler, stopping),
+            kwargs=dict(
+                use_gitignore=use_gitignore,
+                debugging=debugging,
+                use_git=use_git,
+                only_git_changes=only_git_changes,
+            ),
+            daemon=True,
+        )
+        walker.start()
+    elif own_scheduler:
+        scheduler.finish_background()
+    interrupted = False
     try:
         while True:
             time.sleep(0.5)
-            if timeout:
+            event_handler.flush_storm()
+            if timeout and not (walker and walker.is_alive()):
                 raise_if_timeout(event_handler.last_event_timestamp, timeout)
             if terminate_event and terminate_event.is_set():
                 raise ConditionalTermination("Termination condition was set.")
-    except (KeyboardInterrupt, NoChangeTimeout, ConditionalTermination) as e:
+    except KeyboardInterrupt as e:
+        interrupted = True
+        if debugging:
+            print(f"Exitting on {type(e).__name__}: {e}")
+    except (NoChangeTimeout, ConditionalTermination) as e:
         if debugging:
             print(f"Exitting on {type(e).__name__}: {e}")
     finally:
@@ -219,4 +1243,12 @@ def replicate_files_on_change(
         left = now + TAIL_TIMEOUT - time.time()
         observer.stop()
         observer.join(timeout=max(0, left))
+        event_handler.flush_storm(force=True)
+        stopping.set()
+        if own_scheduler:
+            scheduler.close(discard_background=interrupted)
+        if walker is not None:
+            walker.join()
+        if isinstance(spec, GitIgnoreChecker):
+            spec.close()
         print(f"debug: finished replicate on change with {left} left")
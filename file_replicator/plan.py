@@ -0,0 +1,173 @@
+import collections
+import heapq
+import os
+import os.path
+import subprocess
+import time
+
+from .git import is_git_work_tree, iter_git_ignored
+from .lib import archive_size, get_pathspec, iter_files_to_replicate
+from .verify import find_differences
+
+__all__ = ["make_plan", "probe_link"]
+
+# Number of largest files, directories and ignored paths to report.
+TOP_COUNT = 10
+
+# Amount of (incompressible) data sent through the connection to measure throughput.
+PROBE_BYTES = 4 * 1024 * 1024
+
+LinkProbe = collections.namedtuple("LinkProbe", ["latency", "bytes_per_second"])
+
+
+def probe_link(connection_command, nbytes=PROBE_BYTES):
+    """Measure the latency and throughput of the connection.
+
+    The latency is the time to start the connection and run nothing, and the throughput
+    that of sending nbytes through it, once the latency is allowed for.
+    """
+
+    def timed_run(data):
+        start = time.monotonic()
+        subprocess.run(
+            connection_command, input=data, stdout=subprocess.DEVNULL, check=True
+        )
+        return time.monotonic() - start
+
+    latency = timed_run(b"exit\n")
+    seconds = timed_run(b"cat > /dev/null\n" + os.urandom(nbytes))
+    return LinkProbe(latency, nbytes / max(seconds - latency, 1e-3))
+
+
+def lstat_size(path):
+    try:
+        return os.lstat(path).st_size
+    except OSError:
+        return 0
+
+
+def tree_size(path):
+    """Return the total size and number of the files at or below the path."""
+    if not os.path.isdir(path) or os.path.islink(path):
+        return lstat_size(path), 1
+    size = count = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += lstat_size(os.path.join(dirpath, filename))
+            count += 1
+    return size, count
+
+
+def iter_ignored(src_dir, use_gitignore=True, use_git=True):
+    """Yield paths (relative to src_dir) of ignored files and (top) directories."""
+    if not use_gitignore:
+        return
+    if use_git and is_git_work_tree(src_dir):
+        for path in iter_git_ignored(src_dir):
+            yield path.rstrip("/")
+        return
+    spec = get_pathspec(src_dir, use_gitignore)
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        rel_dirpath = os.path.relpath(dirpath, src_dir)
+        for dirname in list(dirnames):
+            path = os.path.normpath(os.path.join(rel_dirpath, dirname))
+            if spec.match_file(path + "/"):
+                dirnames.remove(dirname)
+                yield path
+        for filename in filenames:
+            path = os.path.normpath(os.path.join(rel_dirpath, filename))
+            if spec.match_file(path):
+                yield path
+
+
+def largest(sizes, count):
+    return [
+        {"path": path, "bytes": size}
+        for path, size in heapq.nlargest(count, sizes, key=lambda item: item[1])
+    ]
+
+
+def make_plan(
+    src_dir,
+    dest_parent_dir=None,
+    connection_command=None,
+    use_gitignore=True,
+    use_git=True,
+    only_git_changes=False,
+    reconcile=False,
+    probe_bytes=PROBE_BYTES,
+    top_count=TOP_COUNT,
+    debugging=False,
+):
+    """Work out what replicating src_dir would send, without sending anything.
+
+    Return a dict (ready to be output as JSON) of the number and total size of the files
+    to replicate, the largest files and directories among them, the ignored files and
+    directories (with their sizes), and how long sending would take.
+
+    The time is estimated from probing the connection with probe_bytes of data, if a
+    connection_command is given (and probe_bytes isn't 0). With reconcile, just the files
+    which differ in the destination (see find_differences()) are counted as to be sent.
+    """
+    src_dir = os.path.abspath(src_dir)
+    file_sizes = {}
+    dir_sizes = collections.Counter()
+    for filename in iter_files_to_replicate(
+        src_dir, use_gitignore, use_git, only_git_changes, debugging
+    ):
+        path = os.path.relpath(filename, src_dir)
+        size = file_sizes[path] = lstat_size(filename)
+        parent = os.path.dirname(path)
+        while parent:
+            dir_sizes[parent] += size
+            parent = os.path.dirname(parent)
+
+    ignored = []
+    for path in iter_ignored(src_dir, use_gitignore, use_git):
+        size, count = tree_size(os.path.join(src_dir, path))
+        ignored.append({"path": path, "bytes": size, "file_count": count})
+    ignored.sort(key=lambda item: item["bytes"], reverse=True)
+
+    to_send = list(file_sizes)
+    drift = None
+    if reconcile and connection_command:
+        report = find_differences(
+            src_dir,
+            dest_parent_dir,
+            connection_command,
+            use_gitignore,
+            use_git,
+            debugging,
+        )
+        to_send = report.differing_files
+        drift = {
+            "differing_files": len(report.differing_files),
+            "extra_paths": report.extra_paths,
+            "round_trips": report.round_trips,
+        }
+    send_bytes = archive_size(os.path.join(src_dir, path) for path in to_send)
+
+    link = None
+    estimated_seconds = None
+    if connection_command and probe_bytes:
+        probe = probe_link(connection_command, probe_bytes)
+        link = probe._asdict()
+        estimated_seconds = probe.latency + send_bytes / probe.bytes_per_second
+        if debugging:
+            print(f"Probed connection: {probe}")
+
+    return {
+        "src_dir": src_dir,
+        "file_count": len(file_sizes),
+        "total_bytes": sum(file_sizes.values()),
+        "largest_files": largest(file_sizes.items(), top_count),
+        "largest_dirs": largest(dir_sizes.items(), top_count),
+        "ignored_count": len(ignored),
+        "ignored_bytes": sum(item["bytes"] for item in ignored),
+        "largest_ignored": ignored[:top_count],
+        "reconcile": drift,
+        "files_to_send": len(to_send),
+        "bytes_to_send": send_bytes,
+        "link": link,
+        "estimated_seconds": estimated_seconds,
+    }
@@ -0,0 +1,286 @@
+import array
+import hashlib
+import os
+import os.path
+import stat
+import threading
+import time
+
+__all__ = ["FileState", "FileStateStore", "content_digest"]
+
+# Approximate memory used by a FileStateStore per file, including a typical (short)
+# file name but not the directory names, which are shared. The tests check this.
+BYTES_PER_FILE_BUDGET = 200
+
+DIGEST_SIZE = 20  # sha1
+NO_DIGEST = bytes(DIGEST_SIZE)
+
+# Files larger than this are not hashed, so any change to them is taken to be a change
+# of content.
+DIGEST_SIZE_LIMIT = 16 * 1024 * 1024
+
+# A file recorded within this long of its mtime is "racy": it could be changed again
+# without changing its size or mtime (given coarse timestamps), so its stat can't be
+# trusted to show it is unchanged. This is the same problem (and fix) as git's racy
+# index entries.
+RACY_WINDOW_NS = 2 * 1000000000
+
+# Kinds of change, as given by FileStateStore.classify_change().
+UNCHANGED = "unchanged"
+METADATA = "metadata"
+CONTENT = "content"
+
+
+def content_digest(filename, size_limit=DIGEST_SIZE_LIMIT):
+    """Return the sha1 digest of a regular file, or None if too big (or not a file)."""
+    h = hashlib.sha1()
+    try:
+        with open(filename, "rb") as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode) or st.st_size > size_limit:
+                return None
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.digest()
+
+
+class FileState:
+    """What we know of one file: its size, mtime_ns, mode, (optional) digest and
+    whether it was racy (see RACY_WINDOW_NS) when recorded."""
+
+    __slots__ = ("size", "mtime_ns", "mode", "digest", "racy")
+
+    def __init__(self, size, mtime_ns, mode=0, digest=None, racy=False):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.mode = mode
+        self.digest = digest
+        self.racy = racy
+
+    def __eq__(self, other):
+        if not isinstance(other, FileState):
+            return NotImplemented
+        return (self.size, self.mtime_ns, self.mode, self.digest, self.racy) == (
+            other.size,
+            other.mtime_ns,
+            other.mode,
+            other.digest,
+            other.racy,
+        )
+
+    def __repr__(self):
+        return (
+            f"FileState(size={self.size}, mtime_ns={self.mtime_ns}, "
+            f"mode={self.mode:o}, digest={self.digest!r}, racy={self.racy})"
+        )
+
+    @classmethod
+    def from_stat(cls, st, digest=None, now_ns=None):
+        if now_ns is None:
+            now_ns = int(time.time() * 1e9)
+        racy = now_ns - st.st_mtime_ns < RACY_WINDOW_NS
+        return cls(st.st_size, st.st_mtime_ns, st.st_mode, digest, racy)
+
+    def same_stat(self, st):
+        """Return whether the stat result has the same size, mtime_ns and mode."""
+        return (self.size, self.mtime_ns, self.mode) == (
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_mode,
+        )
+
+
+class FileStateStore:
+    """A compact mapping of file paths to FileStates, for trees of millions of files.
+
+    Directory paths are interned, so each is held just once, and the states are held
+    in array columns indexed by row number rather than as objects per file. FileState
+    objects are only made when asked for with get().
+
+    It is safe to update from several threads.
+    """
+
+    def __init__(self):
+        self._rows_by_dir = {}  # dirname -> {basename: row}
+        self._sizes = array.array("q")
+        self._mtimes = array.array("q")
+        self._modes = array.array("I")
+        self._digests = bytearray()
+        self._racy = bytearray()
+        self._free_rows = []
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, path):
+        with self._lock:
+            return self._find_row(path) is not None
+
+    def __iter__(self):
+        # A directory at a time, rather than copying every path at once.
+        with self._lock:
+            dirnames = list(self._rows_by_dir)
+        for dirname in dirnames:
+            with self._lock:
+                basenames = list(self._rows_by_dir.get(dirname, ()))
+            for basename in basenames:
+                yield os.path.join(dirname, basename)
+
+    def _find_row(self, path):
+        dirname, basename = os.path.split(path)
+        rows = self._rows_by_dir.get(dirname)
+        if rows is None:
+            return None
+        return rows.get(basename)
+
+    def get(self, path):
+        """Return the FileState of the path, or None if not known."""
+        # Under the lock, so that the row isn't freed and reused meanwhile.
+        with self._lock:
+            row = self._find_row(path)
+            if row is None:
+                return None
+            offset = row * DIGEST_SIZE
+            digest = bytes(self._digests[offset : offset + DIGEST_SIZE])
+            return FileState(
+                self._sizes[row],
+                self._mtimes[row],
+                self._modes[row],
+                None if digest == NO_DIGEST else digest,
+                bool(self._racy[row]),
+            )
+
+    def set(self, path, state):
+        """Set the FileState of the path."""
+        dirname, basename = os.path.split(path)
+        digest = state.digest or NO_DIGEST
+        with self._lock:
+            rows = self._rows_by_dir.get(dirname)
+            if rows is None:
+                rows = self._rows_by_dir[dirname] = {}
+            row = rows.get(basename)
+            if row is None:
+                self._count += 1
+                if self._free_rows:
+                    row = self._free_rows.pop()
+                else:
+                    row = len(self._sizes)
+                    self._sizes.append(0)
+                    self._mtimes.append(0)
+                    self._modes.append(0)
+                    self._digests.extend(NO_DIGEST)
+                    self._racy.append(0)
+                rows[basename] = row
+            self._sizes[row] = state.size
+            self._mtimes[row] = state.mtime_ns
+            self._modes[row] = state.mode
+            self._digests[row * DIGEST_SIZE : (row + 1) * DIGEST_SIZE] = digest
+            self._racy[row] = state.racy
+
+    def discard(self, path):
+        """Forget the path, if known."""
+        dirname, basename = os.path.split(path)
+        with self._lock:
+            rows = self._rows_by_dir.get(dirname)
+            if rows is None or basename not in rows:
+                return
+            self._free_rows.append(rows.pop(basename))
+            self._count -= 1
+            if not rows:
+                del self._rows_by_dir[dirname]
+
+    def record(self, path, digest=None):
+        """Set the state of the path from the filesystem (or forget it if missing).
+
+        This must be done before sending the file, so that any change made while it is
+        being sent shows up as a change from what is recorded.
+
+        Return the new FileState, or None.
+        """
+        try:
+            st = os.lstat(path)
+        except OSError:
+            self.discard(path)
+            return None
+        state = FileState.from_stat(st, digest)
+        self.set(path, state)
+        return state
+
+    def record_content(self, path, digests=None):
+        """Set the state of the path as record() does, with the digest of its content.
+
+        A digest worked out by classify_change() (put in digests) is used rather than
+        reading the file again, if the file's stat hasn't changed since.
+        """
+        known = None if digests is None else digests.get(path)
+        if known is not None:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                st = None
+            if st is not None and known.same_stat(st):
+                return self.record(path, digest=known.digest)
+        return self.record(path, digest=content_digest(path))
+
+    def record_metadata(self, path):
+        """Set the size, mtime_ns and mode of the path, keeping its known digest."""
+        state = self.get(path)
+        return self.record(path, digest=state.digest if state else None)
+
+    def classify_change(self, path, digests=None):
+        """Classify how the path has changed since its state was recorded.
+
+        Return UNCHANGED, METADATA (just the mode or mtime_ns of a regular file have
+        changed, and it has a digest showing the same content) or CONTENT (anything else,
+        including not knowing).
+
+        The content is always checked against the digest, if known, as a file can be
+        rewritten without changing its size or mtime. Without a digest, a racy file
+        is taken to have changed. If digests (a dict) is given, the FileState the content
+        was checked against is put in it, for record_content().
+        """
+        state = self.get(path)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return CONTENT
+        if (
+            state is None
+            or not stat.S_ISREG(st.st_mode)
+            or stat.S_IFMT(state.mode) != stat.S_IFMT(st.st_mode)
+            or state.size != st.st_size
+        ):
+            return CONTENT
+        if state.digest is not None:
+            digest = content_digest(path)
+            if digests is not None:
+                digests[path] = FileState.from_stat(st, digest)
+            if digest != state.digest:
+                return CONTENT
+        elif state.mtime_ns != st.st_mtime_ns or state.racy:
+            return CONTENT
+        if state.mtime_ns == st.st_mtime_ns and state.mode == st.st_mode:
+            return UNCHANGED
+        return METADATA
+
+    def is_unchanged(self, path):
+        """Return whether the path is known and its size, mtime_ns and mode unchanged.
+
+        If it was racy when recorded, its content must match the digest too.
+        """
+        state = self.get(path)
+        if state is None:
+            return False
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        if not state.same_stat(st):
+            return False
+        if not state.racy:
+            return True
+        return state.digest is not None and content_digest(path) == state.digest
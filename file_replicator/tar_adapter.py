@@ -1,7 +1,12 @@
+import copy
+import shlex
 import subprocess
 from abc import ABCMeta, abstractmethod
 
 __all__ = [
+    "FILES_FROM",
+    "SPARSE",
+    "PAX",
     "GnuTarAdapter",
     "BsdTarAdapter",
     "BusyBoxTarAdapter",
@@ -10,7 +15,34 @@ __all__ = [
 ]
 
 
+# Optional capabilities of a tar, which detect_local_tar() and detect_remote_tar() probe
+# for. FILES_FROM is reading NUL separated file names from stdin (so any number of files,
+# with any names, can be sent in one archive), SPARSE is archiving holes in sparse files
+# efficiently and PAX is using the pax format (for long names and precise mtimes).
+FILES_FROM = "files-from"
+SPARSE = "sparse"
+PAX = "pax"
+
+# Capabilities which the receiving tar must have too, for the sender to use them.
+RECEIVER_CAPABILITIES = frozenset([PAX])
+
+
+def run_local_script(script):
+    """Run a (POSIX shell) script locally, returning its output."""
+    return subprocess.run(
+        ["/bin/sh"], input=script, stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+
+
 class AbstractTarAdapter(metaclass=ABCMeta):
+    # The options for each optional capability the flavor may have.
+    capability_options = {}
+    # Capabilities taken for granted unless probed for.
+    assumed_capabilities = frozenset()
+
+    def __init__(self):
+        self.capabilities = frozenset(self.assumed_capabilities)
+
     @abstractmethod
     def __str__(self):
         raise NotImplementedError
@@ -30,7 +62,7 @@ class AbstractTarAdapter(metaclass=ABCMeta):
         raise NotImplementedError
 
     @abstractmethod
-    def sender_options(self, src_file):
+    def sender_options(self, *src_files):
         raise NotImplementedError
 
     def receiver_cmd(self):
@@ -39,11 +71,33 @@ class AbstractTarAdapter(metaclass=ABCMeta):
     def receiver_cmd_str(self):
         return " ".join(self.receiver_cmd())
 
-    def sender_cmd(self, src_file):
-        return [self.cmd] + self.sender_options(src_file)
+    def capability_sender_options(self):
+        """Return the options for the capabilities in use (except FILES_FROM)."""
+        options = []
+        for capability in sorted(self.capabilities - {FILES_FROM}):
+            options.extend(self.capability_options[capability])
+        return options
 
-    def sender_cmd_str(self, src_file):
-        return " ".join(self.sender_cmd(src_file))
+    def sender_cmd(self, *src_files):
+        return (
+            [self.cmd]
+            + self.capability_sender_options()
+            + self.sender_options(*src_files)
+        )
+
+    def sender_files_from_cmd(self):
+        """Return the sender command reading NUL separated file names from stdin."""
+        if FILES_FROM not in self.capabilities:
+            raise ValueError(f"{self} cannot read file names from stdin")
+        return (
+            [self.cmd]
+            + self.capability_options[FILES_FROM]
+            + self.capability_sender_options()
+            + self.sender_options()
+        )
+
+    def sender_cmd_str(self, *src_files):
+        return " ".join(self.sender_cmd(*src_files))
 
     @property
     def version_option(self):
@@ -53,6 +107,34 @@ class AbstractTarAdapter(metaclass=ABCMeta):
     def match_flavor_output(self, output):
         raise NotImplementedError
 
+    def probe_capabilities(self, run_script=run_local_script):
+        """Set the capabilities to those whose options the tar accepts.
+
+        Each is tried by archiving /dev/null, with the shell script given to run_script()
+        (which returns its output).
+        """
+        checks = []
+        for capability, options in sorted(self.capability_options.items()):
+            names = [] if capability == FILES_FROM else ["/dev/null"]
+            cmd = [self.cmd, *options, *self.sender_options(*names)]
+            checks.append(
+                f"printf '/dev/null\\0' | {' '.join(map(shlex.quote, cmd))} "
+                f">/dev/null 2>&1 && echo {capability}"
+            )
+        output = run_script("\n".join(checks) + "\n") if checks else ""
+        self.capabilities = frozenset(output.split()) & set(self.capability_options)
+
+    def negotiate(self, *receivers):
+        """Return a copy of this (sender) tar, using capabilities the receivers share."""
+        sender = copy.copy(self)
+        sender.capabilities = frozenset(
+            c
+            for c in self.capabilities
+            if c not in RECEIVER_CAPABILITIES
+            or all(c in receiver.capabilities for receiver in receivers)
+        )
+        return sender
+
 
 class PrefixedTarAdapter(AbstractTarAdapter):
     def __init__(self, prefix=""):
@@ -65,28 +147,42 @@ class PrefixedTarAdapter(AbstractTarAdapter):
 
 
 class GnuTarAdapter(PrefixedTarAdapter):
+    capability_options = {
+        FILES_FROM: ["--null", "--files-from=-"],
+        SPARSE: ["--sparse"],
+        PAX: ["--format=pax"],
+    }
+    assumed_capabilities = frozenset([FILES_FROM])
+
     def __str__(self):
         return f"Gnu Tar [{self.cmd}]"
 
     def receiver_options(self):
         return ["--no-same-owner", "--extract", "--verbose"]
 
-    def sender_options(self, src_file):
-        return ["--create", src_file, "--to-stdout", "--ignore-failed-read"]
+    def sender_options(self, *src_files):
+        return ["--create", *src_files, "--to-stdout", "--ignore-failed-read"]
 
     def match_flavor_output(self, output):
         return "GNU tar" in output
 
 
 class BsdTarAdapter(AbstractTarAdapter):
+    capability_options = {
+        FILES_FROM: ["--null", "-T", "-"],
+        SPARSE: ["--read-sparse"],
+        PAX: ["--format", "pax"],
+    }
+    assumed_capabilities = frozenset([FILES_FROM])
+
     def __str__(self):
         return "BSD Tar"
 
     def receiver_options(self):
         return ["-o", "-x", "-v"]
 
-    def sender_options(self, src_file):
-        return ["-c", "-f", "-", src_file]
+    def sender_options(self, *src_files):
+        return ["-c", "-f", "-", *src_files]
 
     def match_flavor_output(self, output):
         return "bsdtar" in output
@@ -99,8 +195,8 @@ class BusyBoxTarAdapter(AbstractTarAdapter):
     def receiver_options(self):
         return ["x", "-v"]
 
-    def sender_options(self, src_file):
-        return ["c", "-f", "-", src_file]
+    def sender_options(self, *src_files):
+        return ["c", "-f", "-", *src_files]
 
     def match_flavor_output(self, output):
         return "busybox" in output
@@ -126,6 +222,7 @@ def detect_local_tar(acceptable=None):
         except (FileNotFoundError, subprocess.CalledProcessError) as e:
             continue
         if tar_flavor.match_flavor_output(result.stdout):
+            tar_flavor.probe_capabilities()
             return tar_flavor
     return None
 
@@ -145,5 +242,13 @@ def detect_remote_tar(connection_command, acceptable=None):
         except (FileNotFoundError, subprocess.CalledProcessError) as e:
             raise RuntimeError(f"Error using connection command: {e}")
         if tar_flavor.match_flavor_output(result.stdout):
+            tar_flavor.probe_capabilities(
+                lambda script: subprocess.run(
+                    connection_command,
+                    input=script,
+                    stdout=subprocess.PIPE,
+                    universal_newlines=True,
+                ).stdout
+            )
             return tar_flavor
     return None
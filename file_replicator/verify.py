@@ -0,0 +1,297 @@
+import bisect
+import collections
+import hashlib
+import math
+import os
+import os.path
+import secrets
+import shlex
+import subprocess
+
+from .lib import get_pathspec, iter_files_to_replicate
+from .state import content_digest
+
+__all__ = ["find_differences", "reconcile"]
+
+# Scripts run on the destination (by bash, through the connection command) to report
+# digests. Each is a { ... } group, so bash reads all of it before running it, leaving
+# the data which follows on stdin to the script.
+#
+# The destination hashes just the source's files, once, keeping the sha1sum output
+# for them (in order) in a cache file. The digest of a directory is then the sha1 of
+# the lines for the files beneath it, so files which are ignored in the source, or
+# only in the destination, make no difference. HashTree lines up the same lines for
+# the source.
+
+# Input: the source's directories (ending with an empty name), then its files, all NUL
+# separated. Output: the (D)irectory and (F)ile entries of those directories in the
+# destination, the (m)issing files and the (d)igest of the whole cache.
+ROOT_DIGEST_CODE = """{{
+export LC_ALL=C
+shopt -s nullglob dotglob
+cache={cache}
+(set -C; : > "$cache") || exit 1
+cd {dest_dir} 2>/dev/null || exit 0
+while IFS= read -r -d '' d && [ -n "$d" ]; do
+    for e in "$d"/*; do
+        if [ -d "$e" ] && [ ! -L "$e" ]; then kind=D; else kind=F; fi
+        printf '%s\\0%s\\0' "$kind" "${{e#./}}"
+    done
+done
+while IFS= read -r -d '' p; do
+    if [ -f "$p" ] && [ -r "$p" ] && [ ! -L "$p" ]; then
+        printf '%s\\0' "$p" >&3
+    else
+        printf 'm\\0%s\\0' "$p"
+    fi
+done 3> "$cache.names"
+xargs -0 -r sha1sum -- < "$cache.names" > "$cache"
+rm -f "$cache.names"
+digest=$(sha1sum < "$cache")
+printf 'd\\0%s\\0' "${{digest%% *}}"
+}}
+"""
+
+# Input: lines of first and last (1-based) line numbers of disjoint ranges of the
+# cache, in order. Output: sha1sum lines of the digest of each range, named by its
+# number.
+CHILD_DIGESTS_CODE = """{{
+export LC_ALL=C
+shopt -s nullglob
+cache={cache}
+tmp=$(mktemp -d) || exit 1
+awk -v tmp="$tmp" '
+    BEGIN {{ i = 1 }}
+    NR == FNR {{ first[++n] = $1; last[n] = $2; next }}
+    {{
+        while (i <= n && FNR > last[i]) {{ if (out) {{ close(out); out = "" }} i++ }}
+        if (i <= n && FNR >= first[i]) {{ out = tmp "/" i; print > out }}
+    }}
+' - "$cache"
+(cd "$tmp" && set -- * && [ $# -gt 0 ] && sha1sum -- "$@")
+rm -rf "$tmp"
+}}
+"""
+
+CLEAN_UP_CODE = """rm -f {cache}
+"""
+
+DriftReport = collections.namedtuple(
+    "DriftReport", ["differing_files", "extra_paths", "round_trips"]
+)
+
+
+def sha1sum_line(digest, path):
+    """Return the line output by sha1sum for the path, including its escaping."""
+    if "\\" in path or "\n" in path:
+        path = path.replace("\\", "\\\\").replace("\n", "\\n")
+        return f"\\{digest}  {path}\n"
+    return f"{digest}  {path}\n"
+
+
+class HashTree:
+    """Digests of the files in the source directory, and the directories they are in.
+
+    Paths are relative, with "." being the top directory. The paths of everything
+    replicated (including symbolic links, which aren't hashed) are in paths.
+    """
+
+    def __init__(self, file_digests, paths=()):
+        self.file_digests = file_digests
+        self.paths = set(file_digests).union(paths)
+        self.children = collections.defaultdict(set)
+        for path in file_digests:
+            while path != ".":
+                parent = os.path.dirname(path) or "."
+                self.children[parent].add(path)
+                path = parent
+        self.sorted_files = sorted(file_digests, key=os.fsencode)
+        self.set_missing(())
+
+    @classmethod
+    def from_src_dir(cls, src_dir, use_gitignore=True, use_git=True):
+        file_digests = {}
+        paths = []
+        for filename in iter_files_to_replicate(src_dir, use_gitignore, use_git):
+            path = os.path.relpath(filename, src_dir)
+            paths.append(path)
+            if os.path.islink(filename):
+                continue
+            digest = content_digest(filename, size_limit=math.inf)
+            if digest is not None:
+                file_digests[path] = digest.hex()
+        return cls(file_digests, paths)
+
+    def is_dir(self, path):
+        return path in self.children
+
+    def directories(self):
+        return sorted(self.children, key=os.fsencode)
+
+    def set_missing(self, missing):
+        """Leave out the files missing in the destination from the lines to hash."""
+        present = [path for path in self.sorted_files if path not in missing]
+        self.keys = [os.fsencode(path) for path in present]
+        self.lines = [
+            os.fsencode(sha1sum_line(self.file_digests[path], path)) for path in present
+        ]
+
+    def line_range(self, path):
+        """Return the (0-based, half open) range of the lines for the path."""
+        if path == ".":
+            return 0, len(self.lines)
+        key = os.fsencode(path)
+        if not self.is_dir(path):
+            i = bisect.bisect_left(self.keys, key)
+            present = i < len(self.keys) and self.keys[i] == key
+            return i, i + present
+        # Everything beneath the directory sorts between "<path>/" and "<path>0".
+        return (
+            bisect.bisect_left(self.keys, key + b"/"),
+            bisect.bisect_left(self.keys, key + b"0"),
+        )
+
+    def digest(self, path):
+        first, last = self.line_range(path)
+        return hashlib.sha1(b"".join(self.lines[first:last])).hexdigest()
+
+
+def run_remote(connection_command, code, data=b""):
+    """Run the bash code through the connection, with the data following it on stdin.
+
+    Return its output.
+    """
+    return subprocess.run(
+        connection_command,
+        input=code.encode() + data,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+
+
+def nul_separated(paths):
+    return b"".join(os.fsencode(path) + b"\0" for path in paths)
+
+
+def find_differences(
+    src_dir,
+    dest_parent_dir,
+    connection_command,
+    use_gitignore=True,
+    use_git=True,
+    debugging=False,
+):
+    """Compare hash trees of the source and destination to find where they differ.
+
+    Directories are compared top-down, descending only into those that differ, so
+    it takes about as many round trips to the destination as the differences are deep
+    (plus one to remove what the destination keeps meanwhile). Each file in the
+    destination is read just once.
+
+    Return a DriftReport of the (relative) source files which are missing or differ in
+    the destination, and of paths only in the destination (excluding ignored paths),
+    looking in the directories of the source.
+    """
+    src_dir = os.path.abspath(src_dir)
+    dest_dir = os.path.join(dest_parent_dir, os.path.basename(src_dir))
+    spec = get_pathspec(src_dir, use_gitignore)
+    local = HashTree.from_src_dir(src_dir, use_gitignore, use_git)
+    cache = f'"${{TMPDIR:-/tmp}}/file-replicator-digests-{secrets.token_hex(8)}"'
+    try:
+        return _compare_hash_trees(
+            local, spec, dest_dir, connection_command, cache, debugging
+        )
+    finally:
+        run_remote(connection_command, CLEAN_UP_CODE.format(cache=cache))
+
+
+def _compare_hash_trees(local, spec, dest_dir, connection_command, cache, debugging):
+    output = run_remote(
+        connection_command,
+        ROOT_DIGEST_CODE.format(cache=cache, dest_dir=shlex.quote(dest_dir)),
+        nul_separated(local.directories()) + b"\0" + nul_separated(local.sorted_files),
+    )
+    round_trips = 1
+    fields = output.split(b"\0")[:-1]
+    missing = set()
+    extra_paths = []
+    root_digest = None
+    for kind, value in zip(fields[::2], fields[1::2]):
+        kind, value = kind.decode(), os.fsdecode(value)
+        if kind == "d":
+            root_digest = value
+        elif kind == "m":
+            missing.add(value)
+        else:
+            path = os.path.normpath(value)
+            if path in local.paths or local.is_dir(path):
+                continue
+            if spec.match_file(path + "/" if kind == "D" else path):
+                continue
+            extra_paths.append(path)
+    if root_digest is None:
+        # No destination directory at all.
+        return DriftReport(list(local.sorted_files), [], round_trips)
+
+    local.set_missing(missing)
+    differing_files = sorted(missing, key=os.fsencode)
+    if root_digest == local.digest("."):
+        pending = []
+    else:
+        pending = ["."]
+    while pending:
+        if debugging:
+            print(f"Comparing digests in {len(pending)} directories")
+        children = []
+        for directory in pending:
+            for path in local.children[directory]:
+                first, last = local.line_range(path)
+                if first < last:
+                    children.append((first, last, path))
+        children.sort()
+        output = run_remote(
+            connection_command,
+            CHILD_DIGESTS_CODE.format(cache=cache),
+            "".join(f"{first + 1} {last}\n" for first, last, _ in children).encode(),
+        )
+        round_trips += 1
+        remote = {}
+        for line in output.decode().splitlines():
+            digest, number = line.split()
+            remote[children[int(number) - 1][2]] = digest
+        next_pending = []
+        for _, _, path in children:
+            if remote.get(path) == local.digest(path):
+                continue
+            if local.is_dir(path):
+                next_pending.append(path)
+            else:
+                differing_files.append(path)
+        pending = next_pending
+    return DriftReport(differing_files, sorted(extra_paths), round_trips)
+
+
+def reconcile(
+    src_dir,
+    dest_parent_dir,
+    connection_command,
+    copy_file,
+    use_gitignore=True,
+    use_git=True,
+    debugging=False,
+):
+    """Copy (using copy_file()) just the files which differ in the destination.
+
+    Return the DriftReport (see find_differences()).
+    """
+    report = find_differences(
+        src_dir, dest_parent_dir, connection_command, use_gitignore, use_git, debugging
+    )
+    if debugging:
+        print(
+            f"Found {len(report.differing_files)} differing files and "
+            f"{len(report.extra_paths)} extra paths in {report.round_trips} round trips"
+        )
+    if report.differing_files:
+        copy_file(*(os.path.join(src_dir, f) for f in report.differing_files))
+    return report
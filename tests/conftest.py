@@ -0,0 +1,50 @@
+import contextlib
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from file_replicator.tar_adapter import GnuTarAdapter, detect_local_tar
+
+
+@pytest.fixture
+def local_tar():
+    acceptable = (GnuTarAdapter(), GnuTarAdapter(prefix="g"))
+    tar = detect_local_tar(acceptable=acceptable)
+    assert tar is not None
+    return tar
+
+
+@contextlib.contextmanager
+def temp_directory():
+    """Context manager for creating and cleaning up a temporary directory."""
+    directory = tempfile.mkdtemp()
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+
+def make_test_file(src_dir, relative_path, text, events=None):
+    """Create a test file of text, optionally blocking on event and notifying when done."""
+    if events and events.wait_on:
+        # wait, but timeout -- in case something goes wrong
+        events.wait_on.wait(5)
+    filename = os.path.join(src_dir, relative_path)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as f:
+        f.write(text)
+    if events and events.created:
+        # allow file change to be picked up by a filesystem observer
+        time.sleep(0.1)
+        events.created.set()
+        print("notified created")
+
+
+def assert_file_contains(filename, text):
+    """Assert that given file contains given text."""
+    with open(filename) as f:
+        assert f.read() == text
@@ -0,0 +1,85 @@
+import asyncio
+import os.path
+
+from file_replicator import aio
+
+from .conftest import assert_file_contains, make_test_file, temp_directory
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_copy_one_file(local_tar):
+    async def replicate(src_dir, dest_parent_dir):
+        async with aio.make_file_replicator(
+            local_tar, local_tar, src_dir, dest_parent_dir, ("bash",)
+        ) as copy_file:
+            await copy_file(os.path.join(src_dir, "test_file.txt"))
+
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        make_test_file(src_dir, "test_file.txt", "hello")
+        run(replicate(src_dir, dest_parent_dir))
+        assert_file_contains(
+            os.path.join(dest_parent_dir, "test/test_file.txt"), "hello"
+        )
+
+
+def test_replicate_all_files_in_several_sessions(local_tar):
+    async def replicate(src_dir, dest_parent_dir):
+        async with aio.make_file_replicator(
+            local_tar, local_tar, src_dir, dest_parent_dir, ("bash",)
+        ) as copy_file:
+            await aio.replicate_all_files(src_dir, copy_file)
+
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dirs = [os.path.join(src_parent_dir, name) for name in ("x", "y")]
+        for src_dir in src_dirs:
+            make_test_file(src_dir, "a.txt", "hello")
+            make_test_file(src_dir, "b/c.txt", "goodbye")
+
+        async def replicate_all():
+            await asyncio.gather(*(replicate(d, dest_parent_dir) for d in src_dirs))
+
+        run(replicate_all())
+        for name in ("x", "y"):
+            assert_file_contains(os.path.join(dest_parent_dir, name, "a.txt"), "hello")
+            assert_file_contains(
+                os.path.join(dest_parent_dir, name, "b/c.txt"), "goodbye"
+            )
+
+
+def test_replicate_files_on_change(local_tar):
+    async def replicate(src_dir, dest_parent_dir):
+        async def change_file_soon():
+            await asyncio.sleep(0.5)
+            make_test_file(src_dir, "b.txt", "goodbye")
+
+        async with aio.make_file_replicator(
+            local_tar, local_tar, src_dir, dest_parent_dir, ("bash",)
+        ) as copy_file:
+            changing = asyncio.ensure_future(change_file_soon())
+            results = [
+                result
+                async for result in aio.replicate_files_on_change(
+                    src_dir, copy_file, timeout=1
+                )
+            ]
+            await changing
+        return results
+
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        make_test_file(src_dir, "a.txt", "hello")
+        results = run(replicate(src_dir, dest_parent_dir))
+        filename = os.path.join(src_dir, "b.txt")
+        assert (filename,) in [result.filenames for result in results]
+        assert not os.path.exists(os.path.join(dest_parent_dir, "test/a.txt"))
+        assert_file_contains(os.path.join(dest_parent_dir, "test/b.txt"), "goodbye")
@@ -0,0 +1,180 @@
+import os.path
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+from file_replicator.daemon import Daemon, DaemonError, send_command
+from file_replicator.lib import SchedulerClosed
+
+from .conftest import assert_file_contains, make_test_file, temp_directory
+
+
+def wait_for(condition, timeout=5):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout, "timed out"
+        time.sleep(0.1)
+
+
+@pytest.fixture
+def daemon_socket(local_tar):
+    with temp_directory() as socket_dir:
+        socket_path = os.path.join(socket_dir, "control.sock")
+        daemon = Daemon(local_tar)
+        t = threading.Thread(target=daemon.serve, args=(socket_path,))
+        t.start()
+        wait_for(daemon.ready.is_set)
+        try:
+            yield socket_path
+        finally:
+            daemon.shutdown()
+            t.join()
+
+
+def test_daemon_control(daemon_socket):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        dest_dir = os.path.join(dest_parent_dir, "test")
+        make_test_file(src_dir, "a.txt", "hello")
+
+        send_command(
+            daemon_socket,
+            "add",
+            name="test",
+            src_dir=src_dir,
+            dest_parent_dir=dest_parent_dir,
+            connection_command=["bash"],
+        )
+        with pytest.raises(DaemonError):
+            send_command(
+                daemon_socket,
+                "add",
+                name="test",
+                src_dir=src_dir,
+                dest_parent_dir=dest_parent_dir,
+                connection_command=["bash"],
+            )
+        wait_for(lambda: os.path.exists(os.path.join(dest_dir, "a.txt")))
+        time.sleep(0.5)  # let the watcher settle
+
+        # Changes are held back while paused.
+        send_command(daemon_socket, "pause", name="test")
+        make_test_file(src_dir, "b.txt", "goodbye")
+        time.sleep(1)
+        assert not os.path.exists(os.path.join(dest_dir, "b.txt"))
+        status = send_command(daemon_socket, "status")["test"]
+        assert status["paused"]
+        assert status["pending"] >= 1
+        send_command(daemon_socket, "resume", name="test")
+        wait_for(lambda: os.path.exists(os.path.join(dest_dir, "b.txt")))
+
+        os.remove(os.path.join(dest_dir, "a.txt"))
+        assert send_command(daemon_socket, "resync", name="test", subtree=".") == 2
+        wait_for(lambda: os.path.exists(os.path.join(dest_dir, "a.txt")))
+
+        # Adding back a removed replication doesn't send unchanged files again.
+        send_command(daemon_socket, "remove", name="test")
+        assert send_command(daemon_socket, "status") == {}
+        send_command(
+            daemon_socket,
+            "add",
+            name="test",
+            src_dir=src_dir,
+            dest_parent_dir=dest_parent_dir,
+            connection_command=["bash"],
+        )
+        time.sleep(1)
+        status = send_command(daemon_socket, "status")["test"]
+        assert status["files_sent"] == 0
+        assert status["files_known"] == 2
+        send_command(daemon_socket, "remove", name="test")
+        with pytest.raises(DaemonError):
+            send_command(daemon_socket, "remove", name="test")
+
+
+def test_socket_is_private_and_not_taken_over(daemon_socket, local_tar):
+    assert stat.S_IMODE(os.stat(daemon_socket).st_mode) == 0o600
+    with pytest.raises(DaemonError):
+        Daemon(local_tar).serve(daemon_socket)
+    assert send_command(daemon_socket, "status") == {}
+
+
+def test_stale_socket_is_replaced(local_tar):
+    with temp_directory() as socket_dir:
+        socket_path = os.path.join(socket_dir, "control.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.bind(socket_path)  # bound but not listening, as if left behind
+        daemon = Daemon(local_tar)
+        t = threading.Thread(target=daemon.serve, args=(socket_path,))
+        t.start()
+        wait_for(daemon.ready.is_set)
+        try:
+            assert send_command(socket_path, "status") == {}
+        finally:
+            daemon.shutdown()
+            t.join()
+
+
+def test_unexpected_errors_are_responses(local_tar):
+    daemon = Daemon(local_tar)
+
+    def status():
+        raise SchedulerClosed("Sending failed")
+
+    daemon.status = status
+    assert daemon.handle({"command": "status"}) == {
+        "ok": False,
+        "error": "SchedulerClosed: Sending failed",
+    }
+
+
+def test_no_response_is_an_error():
+    with temp_directory() as socket_dir:
+        socket_path = os.path.join(socket_dir, "control.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(socket_path)
+            server.listen()
+
+            def hang_up():
+                connection, _ = server.accept()
+                connection.recv(1024)
+                connection.close()
+
+            t = threading.Thread(target=hang_up)
+            t.start()
+            with pytest.raises(DaemonError):
+                send_command(socket_path, "status")
+            t.join()
+
+
+def test_known_state_is_forgotten_when_sending_fails(local_tar):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        dest_dir = os.path.join(dest_parent_dir, "test")
+        for i in range(50):
+            make_test_file(src_dir, f"{i}.txt", "x" * 4000)
+        # A connection which goes away part way through, until the flag is set.
+        flag = os.path.join(src_parent_dir, "flag")
+        connection_command = [
+            "bash",
+            "-c",
+            f"if [ -e {flag} ]; then exec bash; else head -c 100000 >/dev/null; fi",
+        ]
+        daemon = Daemon(local_tar)
+        daemon.add("test", src_dir, dest_parent_dir, connection_command)
+        session = daemon.sessions["test"]
+        wait_for(lambda: session.scheduler.error is not None)
+        with pytest.raises(Exception):
+            daemon.remove("test")
+
+        make_test_file(src_parent_dir, "flag", "")
+        daemon.add("test", src_dir, dest_parent_dir, connection_command)
+        try:
+            wait_for(
+                lambda: os.path.isdir(dest_dir) and len(os.listdir(dest_dir)) == 50
+            )
+        finally:
+            daemon.stop()
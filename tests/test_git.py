@@ -0,0 +1,140 @@
+import os.path
+import subprocess
+
+from watchdog.events import FileModifiedEvent
+
+from file_replicator.git import (
+    GitIgnoreChecker,
+    git_submodules,
+    is_git_work_tree,
+    iter_git_files,
+)
+from file_replicator.lib import GitIgnoreCopyFileEventHandler, iter_files_to_replicate
+
+from .conftest import make_test_file, temp_directory
+
+
+def git(src_dir, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=src_dir,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def make_git_work_tree(src_dir):
+    make_test_file(src_dir, ".gitignore", "*.log\n")
+    make_test_file(src_dir, "tracked.txt", "hello")
+    make_test_file(src_dir, "deleted.txt", "hello")
+    make_test_file(src_dir, "a/b/tracked 2.txt", "hello")
+    make_test_file(src_dir, "a/.gitignore", "build/\n")
+    git(src_dir, "init", "-q")
+    git(src_dir, "add", ".")
+    git(src_dir, "commit", "-q", "-m", "initial")
+    make_test_file(src_dir, "tracked.txt", "hello again")
+    make_test_file(src_dir, "untracked.txt", "hello")
+    make_test_file(src_dir, "ignored.log", "hello")
+    make_test_file(src_dir, "a/build/ignored.txt", "hello")
+    os.remove(os.path.join(src_dir, "deleted.txt"))
+
+
+def test_not_a_git_work_tree():
+    with temp_directory() as src_dir:
+        assert not is_git_work_tree(src_dir)
+
+
+def test_iter_git_files():
+    with temp_directory() as src_dir:
+        make_git_work_tree(src_dir)
+        assert is_git_work_tree(src_dir)
+        assert sorted(iter_git_files(src_dir)) == [
+            ".gitignore",
+            "a/.gitignore",
+            "a/b/tracked 2.txt",
+            "tracked.txt",
+            "untracked.txt",
+        ]
+        assert sorted(iter_git_files(src_dir, modified_only=True)) == [
+            "tracked.txt",
+            "untracked.txt",
+        ]
+
+
+def test_iter_files_to_replicate_with_and_without_git():
+    with temp_directory() as src_dir:
+        make_git_work_tree(src_dir)
+        with_git = sorted(iter_files_to_replicate(src_dir))
+        assert os.path.join(src_dir, "a/build/ignored.txt") not in with_git
+
+        # The fallback only knows about the top level .gitignore (and sees .git).
+        without_git = sorted(iter_files_to_replicate(src_dir, use_git=False))
+        assert os.path.join(src_dir, "a/build/ignored.txt") in without_git
+        assert set(with_git) < set(without_git)
+
+
+def test_iter_files_to_replicate_in_a_subtree():
+    with temp_directory() as src_dir:
+        make_git_work_tree(src_dir)
+        for use_git in (True, False):
+            assert sorted(
+                iter_files_to_replicate(src_dir, use_git=use_git, subtree="a/b")
+            ) == [os.path.join(src_dir, "a/b/tracked 2.txt")]
+            assert list(
+                iter_files_to_replicate(src_dir, use_git=use_git, subtree="tracked.txt")
+            ) == [os.path.join(src_dir, "tracked.txt")]
+
+
+def test_git_ignore_checker_follows_all_of_gits_rules():
+    with temp_directory() as src_dir:
+        make_git_work_tree(src_dir)
+        make_test_file(src_dir, "a/keep.log", "hello")
+        make_test_file(src_dir, "a/.gitignore", "build/\n!keep.log\n")
+        checker = GitIgnoreChecker(src_dir)
+        try:
+            assert checker.match_file(os.path.join(src_dir, "a/build/ignored.txt"))
+            assert checker.match_file(os.path.join(src_dir, "a/build/new.txt"))
+            assert checker.match_file("ignored.log")
+            assert checker.match_file(".git/index")
+            assert not checker.match_file(os.path.join(src_dir, "a/b/tracked 2.txt"))
+            assert not checker.match_file("a/keep.log")
+            assert not checker.match_file("untracked.txt")
+        finally:
+            checker.close()
+
+
+def test_changes_ignored_by_nested_gitignore_files_are_not_sent():
+    with temp_directory() as src_dir:
+        make_git_work_tree(src_dir)
+        sent = []
+        checker = GitIgnoreChecker(src_dir)
+        handler = GitIgnoreCopyFileEventHandler(
+            lambda *filenames: sent.extend(filenames), checker
+        )
+        try:
+            for path in ("a/build/ignored.txt", "untracked.txt"):
+                handler.dispatch(FileModifiedEvent(os.path.join(src_dir, path)))
+        finally:
+            checker.close()
+        assert sent == [os.path.join(src_dir, "untracked.txt")]
+
+
+def test_submodules_are_left_out():
+    with temp_directory() as src_dir:
+        make_git_work_tree(src_dir)
+        submodule_dir = os.path.join(src_dir, "sub")
+        make_test_file(submodule_dir, "module.txt", "hello")
+        make_test_file(submodule_dir, "build/output.o", "ignored in the submodule")
+        git(submodule_dir, "init", "-q")
+        git(submodule_dir, "add", "module.txt")
+        git(submodule_dir, "commit", "-q", "-m", "initial")
+        git(src_dir, "add", "sub")
+        assert git_submodules(src_dir) == {"sub"}
+        assert "sub" not in list(iter_git_files(src_dir))
+        checker = GitIgnoreChecker(src_dir)
+        try:
+            assert checker.match_file("sub")
+            assert checker.match_file(os.path.join(submodule_dir, "module.txt"))
+            assert not checker.match_file("untracked.txt")
+        finally:
+            checker.close()
@@ -1,56 +1,28 @@
 from collections import namedtuple
-import contextlib
 import os
 import os.path
-import shutil
-import tempfile
+import subprocess
 import time
 import threading
 
 import pytest
+from watchdog.events import FileCreatedEvent, FileModifiedEvent
 
 from file_replicator.lib import *
-from file_replicator.tar_adapter import GnuTarAdapter, detect_local_tar
-
-
-@pytest.fixture
-def local_tar():
-    acceptable = (GnuTarAdapter(), GnuTarAdapter(prefix="g"))
-    tar = detect_local_tar(acceptable=acceptable)
-    assert tar is not None
-    return tar
-
-
-@contextlib.contextmanager
-def temp_directory():
-    """Context manager for creating and cleaning up a temporary directory."""
-    directory = tempfile.mkdtemp()
-    try:
-        yield directory
-    finally:
-        shutil.rmtree(directory)
-
-
-def make_test_file(src_dir, relative_path, text, events=None):
-    """Create a test file of text, optionally blocking on event and notifying when done."""
-    if events and events.wait_on:
-        # wait, but timeout -- in case something goes wrong
-        events.wait_on.wait(5)
-    filename = os.path.join(src_dir, relative_path)
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "w") as f:
-        f.write(text)
-    if events and events.created:
-        # allow file change to be picked up by a filesystem observer
-        time.sleep(0.1)
-        events.created.set()
-        print("notified created")
-
-
-def assert_file_contains(filename, text):
-    """Assert that given file contains given text."""
-    with open(filename) as f:
-        assert f.read() == text
+from file_replicator.lib import (
+    BULK,
+    MIN_BATCH_BYTES,
+    READ_CHUNK_SIZE,
+    BatchSizer,
+    CopyFileEventHandler,
+    DestinationWriter,
+    SendScheduler,
+    TokenBucket,
+)
+from file_replicator.state import FileStateStore
+from file_replicator.tar_adapter import GnuTarAdapter
+
+from .conftest import assert_file_contains, make_test_file, temp_directory
 
 
 def test_empty_directories_are_copied(local_tar):
@@ -93,6 +65,28 @@ def test_copy_file_with_unusual_characters_in_name(local_tar):
         )
 
 
+def test_copy_files_named_like_options(local_tar):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        make_test_file(src_dir, "--remove-files", "hello")
+        make_test_file(src_dir, "-v", "goodbye")
+        without_files_from = GnuTarAdapter(local_tar._prefix)
+        without_files_from.capabilities = frozenset()
+        for tar in (local_tar, without_files_from):
+            with make_file_replicator(
+                tar, tar, src_dir, dest_parent_dir, ("bash",)
+            ) as copy_file:
+                copy_file(
+                    os.path.join(src_dir, "--remove-files"),
+                    os.path.join(src_dir, "-v"),
+                )
+            assert_file_contains(os.path.join(src_dir, "--remove-files"), "hello")
+            assert_file_contains(
+                os.path.join(dest_parent_dir, "test/--remove-files"), "hello"
+            )
+            assert_file_contains(os.path.join(dest_parent_dir, "test/-v"), "goodbye")
+
+
 def test_make_missing_parent_directories(local_tar):
     with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
         src_dir = os.path.join(src_parent_dir, "test")
@@ -120,6 +114,377 @@ def test_replicate_all_files(local_tar):
         assert_file_contains(os.path.join(src_dir, "b/c.txt"), "goodbye")
 
 
+def test_copy_several_files_at_once(local_tar):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        make_test_file(src_dir, "a.txt", "hello")
+        make_test_file(src_dir, "b/c.txt", "goodbye")
+        with make_file_replicator(
+            local_tar, local_tar, src_dir, dest_parent_dir, ("bash",)
+        ) as copy_file:
+            copy_file(os.path.join(src_dir, "a.txt"), os.path.join(src_dir, "b/c.txt"))
+        assert_file_contains(os.path.join(dest_parent_dir, "test/a.txt"), "hello")
+        assert_file_contains(os.path.join(dest_parent_dir, "test/b/c.txt"), "goodbye")
+
+
+def test_copy_to_several_destinations(local_tar):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        make_test_file(src_dir, "a.txt", "hello")
+        make_test_file(src_dir, "b/c.txt", "goodbye" * 100000)
+        other_dest_parent_dirs = [os.path.join(dest_parent_dir, d) for d in "xy"]
+        with make_file_replicator(
+            local_tar,
+            local_tar,
+            src_dir,
+            dest_parent_dir,
+            ("bash",),
+            extra_destinations=[
+                Destination(local_tar, d, ("bash",)) for d in other_dest_parent_dirs
+            ],
+        ) as copy_file:
+            copy_file(os.path.join(src_dir, "a.txt"))
+            copy_file(os.path.join(src_dir, "b/c.txt"))
+        for d in [dest_parent_dir, *other_dest_parent_dirs]:
+            assert_file_contains(os.path.join(d, "test/a.txt"), "hello")
+            assert_file_contains(os.path.join(d, "test/b/c.txt"), "goodbye" * 100000)
+
+
+def test_failed_destination_does_not_stop_the_others(local_tar):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        make_test_file(src_dir, "a.txt", "hello")
+        make_test_file(src_dir, "b/c.txt", "goodbye" * 100000)
+        other_dest_parent_dir = os.path.join(dest_parent_dir, "other")
+        with pytest.raises(RuntimeError, match="head -c 10000"):
+            with make_file_replicator(
+                local_tar,
+                local_tar,
+                src_dir,
+                dest_parent_dir,
+                ("bash",),
+                extra_destinations=[
+                    # Goes away part way through the first archive.
+                    Destination(
+                        local_tar, "/unused", ("bash", "-c", "head -c 10000 >/dev/null")
+                    ),
+                    Destination(local_tar, other_dest_parent_dir, ("bash",)),
+                ],
+            ) as copy_file:
+                copy_file(os.path.join(src_dir, "b/c.txt"))
+                copy_file(os.path.join(src_dir, "a.txt"))
+        for d in [dest_parent_dir, other_dest_parent_dir]:
+            assert_file_contains(os.path.join(d, "test/a.txt"), "hello")
+            assert_file_contains(os.path.join(d, "test/b/c.txt"), "goodbye" * 100000)
+
+
+def test_destination_writer_drains():
+    process = subprocess.Popen(
+        ["bash", "-c", "sleep 0.5; cat >/dev/null"], stdin=subprocess.PIPE
+    )
+    writer = DestinationWriter(process, "slow")
+    start = time.monotonic()
+    writer.write(b"x" * 1024 * 1024)
+    writer.flush()
+    assert time.monotonic() - start < 0.4  # just queued
+    writer.drain()
+    assert time.monotonic() - start >= 0.5
+    writer.close()
+    process.stdin.close()
+    process.wait()
+
+
+def test_update_metadata_only(local_tar):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        filename = os.path.join(src_dir, "a b.txt")
+        dest_filename = os.path.join(dest_parent_dir, "test/a b.txt")
+        make_test_file(src_dir, "a b.txt", "hello")
+        with make_file_replicator(
+            local_tar, local_tar, src_dir, dest_parent_dir, ("bash",)
+        ) as copy_file:
+            copy_file(filename)
+            os.chmod(filename, 0o751)
+            os.utime(filename, ns=(1500000000123456789, 1500000000123456789))
+            copy_file.update_metadata(filename)
+        st = os.stat(dest_filename)
+        assert st.st_mode & 0o777 == 0o751
+        assert st.st_mtime_ns == 1500000000123456789
+        assert_file_contains(dest_filename, "hello")
+
+
+def test_changes_are_classified_before_sending():
+    with temp_directory() as src_dir:
+        sent = []
+        handler = CopyFileEventHandler(
+            lambda *filenames: sent.append(("content", filenames)),
+            update_metadata=lambda *filenames: sent.append(("metadata", filenames)),
+        )
+        filename = os.path.join(src_dir, "a.txt")
+        make_test_file(src_dir, "a.txt", "hello")
+        handler.dispatch(FileCreatedEvent(filename))
+        handler.dispatch(FileModifiedEvent(filename))
+        assert sent == [("content", (filename,))]
+
+        os.chmod(filename, 0o600)
+        handler.dispatch(FileModifiedEvent(filename))
+        os.utime(filename, ns=(1, 1))
+        handler.dispatch(FileModifiedEvent(filename))
+        assert sent[1:] == [("metadata", (filename,))] * 2
+
+        make_test_file(src_dir, "a.txt", "HELLO")
+        handler.dispatch(FileModifiedEvent(filename))
+        assert sent[3:] == [("content", (filename,))]
+
+
+def test_changes_while_sending_are_sent_again():
+    with temp_directory() as src_dir:
+        sent = []
+        filename = os.path.join(src_dir, "a.txt")
+
+        def copy_file(*filenames):
+            with open(filename) as f:
+                sent.append(f.read())
+            # Rewritten after tar has read it, keeping the size.
+            if len(sent) == 1:
+                make_test_file(src_dir, "a.txt", "HELLO")
+
+        handler = CopyFileEventHandler(copy_file)
+        make_test_file(src_dir, "a.txt", "hello")
+        handler.dispatch(FileCreatedEvent(filename))
+        handler.dispatch(FileModifiedEvent(filename))
+        assert sent == ["hello", "HELLO"]
+
+
+def test_event_storm_is_sent_in_bulk_once_settled():
+    with temp_directory() as src_dir:
+        sent = []
+        handler = CopyFileEventHandler(
+            lambda *filenames: sent.append(filenames), storm_threshold=5
+        )
+        filenames = [os.path.join(src_dir, f"d/{i}.txt") for i in range(20)]
+        for filename in filenames:
+            make_test_file(src_dir, filename, "hello")
+            handler.dispatch(FileCreatedEvent(filename))
+
+        # The first few changes are sent as they happen, the rest are held back.
+        assert sent == [(filename,) for filename in filenames[:5]]
+        handler.flush_storm()
+        assert len(sent) == 5
+        handler.flush_storm(force=True)
+
+        # Only the files not already sent are sent in bulk.
+        assert len(sent) == 6
+        assert sorted(sent[-1]) == sorted(filenames[5:])
+        handler.flush_storm(force=True)
+        assert len(sent) == 6
+
+
+def test_urgent_copies_jump_the_queue_and_are_not_repeated():
+    sent = []
+    gate = threading.Event()
+
+    def copy_file(*filenames):
+        gate.wait(5)
+        sent.append(filenames)
+
+    scheduler = SendScheduler(copy_file)
+    scheduler.start()
+    scheduler.copy_file_in_background("/src/1")
+    time.sleep(0.1)  # let the worker get stuck sending the first file
+    scheduler.copy_file_in_background("/src/2")
+    scheduler.copy_file_in_background("/src/3")
+    scheduler.copy_file_urgently("/src/3")
+    scheduler.copy_file_in_background("/src/3")
+    gate.set()
+    scheduler.close()
+    assert sent == [("/src/1",), ("/src/3",), ("/src/2",)]
+
+
+def test_scheduler_records_just_what_it_sends():
+    with temp_directory() as src_dir:
+        filenames = [os.path.join(src_dir, f"{i}.txt") for i in range(3)]
+        for filename in filenames:
+            make_test_file(src_dir, filename, "hello")
+        known_state = FileStateStore()
+        gate = threading.Event()
+        recorded_while_sending = []
+
+        def copy_file(*names):
+            recorded_while_sending.append(names[0] in known_state)
+            if names[0] == filenames[1]:
+                gate.wait(5)
+                raise OSError("Connection lost")
+
+        scheduler = SendScheduler(copy_file, known_state=known_state)
+        scheduler.start()
+        scheduler.copy_file_urgently(filenames[0])
+        wait_until(lambda: scheduler.files_sent == 1)
+        scheduler.copy_file_urgently(filenames[1])
+        wait_until(lambda: len(recorded_while_sending) == 2)
+        scheduler.copy_file_urgently(filenames[2])  # queued, but never sent
+        gate.set()
+        with pytest.raises(OSError):
+            scheduler.close()
+    assert recorded_while_sending == [True, True]
+    assert list(known_state) == [filenames[0]]
+
+
+def test_changes_in_bulk_wait_behind_urgent_changes():
+    sent = []
+    scheduler = SendScheduler(lambda *filenames: sent.append(filenames))
+    scheduler.pause()
+    scheduler.start()
+    scheduler.copy_file_urgently("/src/checkout/1", priority=BULK)
+    scheduler.copy_file_urgently("/src/edited")
+    scheduler.resume()
+    scheduler.close()
+    assert sent == [("/src/edited",), ("/src/checkout/1",)]
+
+
+def test_urgent_copies_are_forgotten_once_background_work_is_done():
+    sent = []
+    scheduler = SendScheduler(lambda *filenames: sent.append(filenames))
+    scheduler.pause()
+    scheduler.start()
+    scheduler.copy_file_in_background("/src/1")
+    scheduler.copy_file_urgently("/src/1")
+    scheduler.finish_background()
+    assert scheduler.sent_urgently == {"/src/1"}
+    scheduler.resume()
+    wait_until(lambda: not scheduler.sent_urgently)
+    scheduler.copy_file_urgently("/src/2")
+    assert scheduler.sent_urgently == set()
+    scheduler.close()
+    assert sent == [("/src/1",), ("/src/2",)]
+
+
+def test_queued_copies_are_packed_together():
+    sent = []
+    with temp_directory() as src_dir:
+        filenames = [os.path.join(src_dir, f"{i}.txt") for i in range(10)]
+        for filename in filenames:
+            make_test_file(src_dir, filename, "hello")
+        scheduler = SendScheduler(lambda *filenames: sent.append(filenames))
+        scheduler.pause()
+        scheduler.start()
+        for filename in filenames:
+            scheduler.copy_file_in_background(filename)
+        scheduler.copy_file_urgently(filenames[0])
+        scheduler.resume()
+        scheduler.close()
+    assert sent == [(filenames[0],), tuple(filenames[1:])]
+
+
+def test_batch_size_follows_measured_throughput():
+    sizer = BatchSizer(target_seconds=0.5)
+    assert sizer.batch_bytes() == MIN_BATCH_BYTES * 8
+    for _ in range(20):
+        sizer.record(1000, 0.1)  # latency
+        sizer.record(10 * 1024 * 1024, 1.1)
+    assert sizer.latency == pytest.approx(0.1, rel=0.01)
+    assert sizer.batch_bytes() == pytest.approx(5 * 1024 * 1024, rel=0.01)
+    for _ in range(20):
+        sizer.record(10 * 1024 * 1024, 100)
+    assert sizer.batch_bytes() == MIN_BATCH_BYTES
+
+
+def test_token_bucket():
+    now = [0.0]
+    bucket = TokenBucket(1000, clock=lambda: now[0])
+    assert bucket.delay() == 0
+    bucket.consume(3000)
+    assert bucket.delay() == pytest.approx(2.0)
+    now[0] = 1.5
+    assert bucket.delay() == pytest.approx(0.5)
+    now[0] = 100
+    assert bucket.delay() == 0
+    assert bucket.tokens == 1000  # bursts are limited to a second's worth
+
+
+def test_token_bucket_throttles_each_chunk():
+    now = [0.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    bucket = TokenBucket(1000, clock=lambda: now[0], sleep=sleep)
+    for _ in range(5):
+        bucket.throttle(600)
+    # A second's worth of burst, then the rest at the rate (the last chunk on credit).
+    assert now[0] == pytest.approx(1.4)
+    assert bucket.delay() == pytest.approx(0.6)
+
+
+def test_throttled_copy_limits_the_data_sent(local_tar):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        make_test_file(src_dir, "big.txt", "x" * 1024 * 1024)
+        chunks = []
+        with make_file_replicator(
+            local_tar, local_tar, src_dir, dest_parent_dir, ("bash",)
+        ) as copy_file:
+            copy_file.copy_file_throttled(
+                chunks.append, os.path.join(src_dir, "big.txt")
+            )
+        assert_file_contains(
+            os.path.join(dest_parent_dir, "test/big.txt"), "x" * 1024 * 1024
+        )
+        # Every byte of the archive went through the throttle, a chunk at a time.
+        assert sum(chunks) > 1024 * 1024
+        assert max(chunks) <= READ_CHUNK_SIZE
+
+
+def test_bulk_sends_are_throttled_as_they_are_sent():
+    sent = []
+
+    def copy_file(*filenames):
+        sent.append(("unthrottled", filenames))
+
+    def copy_file_throttled(throttle, *filenames):
+        throttle(100)
+        sent.append(("throttled", filenames))
+
+    copy_file.copy_file_throttled = copy_file_throttled
+    scheduler = SendScheduler(copy_file, bulk_rate=1000)
+    scheduler.start()
+    scheduler.copy_file_in_background("/src/1")
+    scheduler.copy_file_urgently("/src/2")
+    scheduler.close()
+    assert sorted(sent) == [("throttled", ("/src/1",)), ("unthrottled", ("/src/2",))]
+    assert scheduler.bulk_bucket.tokens == pytest.approx(900, abs=10)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_urgent_copies_are_not_held_up_by_the_bulk_rate():
+    sent = []
+    with temp_directory() as src_dir:
+        make_test_file(src_dir, "big.txt", "x" * 2 * 1024 * 1024)
+        make_test_file(src_dir, "background.txt", "hello")
+        make_test_file(src_dir, "small.txt", "hello")
+        big, background, small = (
+            os.path.join(src_dir, f) for f in ("big.txt", "background.txt", "small.txt")
+        )
+        # So slow that nothing more is sent in the bulk lanes once the big file is.
+        scheduler = SendScheduler(
+            lambda *filenames: sent.append(filenames), bulk_rate=1
+        )
+        scheduler.start()
+        scheduler.copy_file_urgently(big)
+        wait_until(lambda: len(sent) == 1)
+        scheduler.copy_file_in_background(background)
+        scheduler.copy_file_urgently(small)
+        wait_until(lambda: len(sent) == 2)
+        scheduler.close(discard_background=True)
+        assert sent == [(big,), (small,)]
+
+
 EventPair = namedtuple("EventPair", ["wait_on", "created"])
 
 
@@ -256,3 +621,29 @@ def test_detect_and_copy_new_file_in_new_directories(local_tar, delay_events):
         assert_file_contains(
             os.path.join(dest_parent_dir, "test/a/b/c/d/e/a.txt"), "hello again"
         )
+
+
+def test_initial_replication_while_watching(local_tar, delay_events):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        make_test_file(src_dir, "a.txt", "hello")
+        delayed_t = threading.Thread(
+            target=make_test_file, args=(src_dir, "b.txt", "goodbye", delay_events)
+        )
+        delayed_t.start()
+
+        with make_file_replicator(
+            local_tar, local_tar, src_dir, dest_parent_dir, ("bash",)
+        ) as copy_file:
+            replicate_files_on_change(
+                src_dir,
+                copy_file,
+                observer_up_event=delay_events.wait_on,
+                terminate_event=delay_events.created,
+                initial_replication=True,
+            )
+        delayed_t.join()
+
+        # Both the existing and new files are copied.
+        assert_file_contains(os.path.join(dest_parent_dir, "test/a.txt"), "hello")
+        assert_file_contains(os.path.join(dest_parent_dir, "test/b.txt"), "goodbye")
@@ -0,0 +1,75 @@
+import json
+import os.path
+
+from file_replicator.cli import main
+from file_replicator.plan import make_plan, probe_link
+
+from .conftest import make_test_file, temp_directory
+from .test_git import make_git_work_tree
+
+
+def test_plan_without_git():
+    with temp_directory() as src_dir:
+        make_test_file(src_dir, ".gitignore", "*.log\nbuild/\n")
+        make_test_file(src_dir, "a.txt", "x" * 10)
+        make_test_file(src_dir, "b/c.txt", "x" * 1000)
+        make_test_file(src_dir, "b/d/e.txt", "x" * 100)
+        make_test_file(src_dir, "b/f.log", "x" * 5)
+        make_test_file(src_dir, "build/g.txt", "x" * 50)
+        make_test_file(src_dir, "build/h/i.txt", "x" * 50)
+        plan = make_plan(src_dir, use_git=False, top_count=2)
+    assert plan["file_count"] == 4
+    assert plan["total_bytes"] == 10 + 1000 + 100 + len("*.log\nbuild/\n")
+    assert plan["largest_files"] == [
+        {"path": "b/c.txt", "bytes": 1000},
+        {"path": "b/d/e.txt", "bytes": 100},
+    ]
+    assert plan["largest_dirs"] == [
+        {"path": "b", "bytes": 1100},
+        {"path": "b/d", "bytes": 100},
+    ]
+    assert plan["ignored_count"] == 2
+    assert plan["ignored_bytes"] == 105
+    assert plan["largest_ignored"] == [
+        {"path": "build", "bytes": 100, "file_count": 2},
+        {"path": os.path.join("b", "f.log"), "bytes": 5, "file_count": 1},
+    ]
+    assert plan["files_to_send"] == 4
+    assert plan["bytes_to_send"] == 1024 + 4 * 512 + (1 + 1 + 2 + 1) * 512
+    assert plan["link"] is None and plan["estimated_seconds"] is None
+
+
+def test_plan_with_git_and_reconcile():
+    with temp_directory() as src_dir, temp_directory() as dest_parent_dir:
+        make_git_work_tree(src_dir)
+        plan = make_plan(
+            src_dir,
+            dest_parent_dir,
+            ("bash",),
+            reconcile=True,
+            probe_bytes=1024 * 1024,
+        )
+    assert plan["file_count"] == 5
+    assert sorted(item["path"] for item in plan["largest_ignored"]) == [
+        "a/build",
+        "ignored.log",
+    ]
+    assert plan["reconcile"]["differing_files"] == 5
+    assert plan["files_to_send"] == 5
+    assert plan["link"]["bytes_per_second"] > 0
+    assert plan["estimated_seconds"] >= plan["link"]["latency"]
+
+
+def test_probe_link():
+    probe = probe_link(("bash",), 1024)
+    assert probe.latency > 0
+    assert probe.bytes_per_second > 0
+
+
+def test_plan_output_is_just_json(capsys):
+    with temp_directory() as src_dir:
+        make_git_work_tree(src_dir)
+        main.main([src_dir, "/dest", "--plan", "--debugging"], standalone_mode=False)
+    out, err = capsys.readouterr()
+    assert json.loads(out)["file_count"] == 5
+    assert "Listing files using git" in err
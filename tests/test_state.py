@@ -0,0 +1,139 @@
+import os.path
+import sys
+import threading
+import tracemalloc
+
+from file_replicator import state
+from file_replicator.state import (
+    BYTES_PER_FILE_BUDGET,
+    CONTENT,
+    UNCHANGED,
+    FileState,
+    FileStateStore,
+    content_digest,
+)
+
+from .conftest import make_test_file, temp_directory
+
+
+def test_set_get_and_discard():
+    store = FileStateStore()
+    assert store.get("/src/a/b.txt") is None
+    store.set("/src/a/b.txt", FileState(5, 123, 0o100644))
+    store.set("/src/a/c.txt", FileState(6, 456, 0o100755, b"x" * 20))
+    assert len(store) == 2
+    assert "/src/a/b.txt" in store
+    assert store.get("/src/a/b.txt") == FileState(5, 123, 0o100644)
+    assert store.get("/src/a/c.txt") == FileState(6, 456, 0o100755, b"x" * 20)
+    assert sorted(store) == ["/src/a/b.txt", "/src/a/c.txt"]
+
+    store.discard("/src/a/b.txt")
+    store.discard("/src/a/b.txt")
+    assert len(store) == 1
+    assert "/src/a/b.txt" not in store
+
+    # Rows are reused once freed.
+    store.set("/src/d.txt", FileState(7, 789))
+    assert store.get("/src/d.txt") == FileState(7, 789)
+    assert store.get("/src/a/c.txt") == FileState(6, 456, 0o100755, b"x" * 20)
+
+
+def test_record_and_is_unchanged():
+    with temp_directory() as src_dir:
+        filename = os.path.join(src_dir, "a.txt")
+        make_test_file(src_dir, "a.txt", "hello")
+        store = FileStateStore()
+        assert not store.is_unchanged(filename)
+        # Just written, so racy: without a digest its stat can't be trusted.
+        assert store.record(filename).racy
+        assert not store.is_unchanged(filename)
+        assert store.record(filename, digest=content_digest(filename)).size == 5
+        assert store.is_unchanged(filename)
+        os.chmod(filename, 0o600)
+        assert not store.is_unchanged(filename)
+        os.remove(filename)
+        assert store.record(filename) is None
+        assert filename not in store
+
+
+def test_rewrite_keeping_size_and_mtime_is_a_content_change():
+    with temp_directory() as src_dir:
+        filename = os.path.join(src_dir, "a.txt")
+        make_test_file(src_dir, "a.txt", "hello")
+        st = os.stat(filename)
+        store = FileStateStore()
+        store.record(filename, digest=content_digest(filename))
+        make_test_file(src_dir, "a.txt", "HELLO")
+        os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert store.classify_change(filename) == CONTENT
+        assert not store.is_unchanged(filename)
+
+        # Likewise for a racy file without a digest.
+        store.record(filename)
+        assert store.classify_change(filename) == CONTENT
+        store.record(filename, digest=content_digest(filename))
+        assert store.classify_change(filename) == UNCHANGED
+
+
+def test_digest_from_classifying_is_reused_while_the_file_is_unchanged(monkeypatch):
+    with temp_directory() as src_dir:
+        filename = os.path.join(src_dir, "a.txt")
+        make_test_file(src_dir, "a.txt", "hello")
+        store = FileStateStore()
+        store.record(filename, digest=content_digest(filename))
+        make_test_file(src_dir, "a.txt", "HELLO")
+        digests = {}
+        assert store.classify_change(filename, digests) == CONTENT
+        classified_digest = digests[filename].digest
+
+        monkeypatch.setattr(state, "content_digest", None)  # not to be called
+        assert store.record_content(filename, digests).digest == classified_digest
+        monkeypatch.undo()
+
+        # Changed again since it was classified, so read again.
+        make_test_file(src_dir, "a.txt", "HELLO!")
+        digest = store.record_content(filename, digests).digest
+        assert digest == content_digest(filename) != classified_digest
+
+
+def test_memory_per_file_is_within_budget():
+    count = 100000
+    tracemalloc.start()
+    try:
+        store = FileStateStore()
+        for i in range(count):
+            store.set(
+                f"/home/user/project/src/package_{i % 1000}/module_{i}.py",
+                FileState(i, i * 1000000000, 0o100644),
+            )
+        used, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(store) == count
+    assert used / count < BYTES_PER_FILE_BUDGET
+
+
+def test_lookups_while_rows_are_reused():
+    store = FileStateStore()
+    stop = threading.Event()
+
+    def reuse_rows():
+        # Each file takes the row the other has just freed.
+        while not stop.is_set():
+            store.discard("/src/a.txt")
+            store.set("/src/b.txt", FileState(2, 2))
+            store.discard("/src/b.txt")
+            store.set("/src/a.txt", FileState(1, 1))
+
+    store.set("/src/a.txt", FileState(1, 1))
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads often, to give races a chance
+    t = threading.Thread(target=reuse_rows)
+    t.start()
+    try:
+        for _ in range(100000):
+            assert store.get("/src/a.txt") in (None, FileState(1, 1))
+    finally:
+        stop.set()
+        t.join()
+        sys.setswitchinterval(switch_interval)
@@ -5,6 +5,9 @@ from pathlib import Path
 import pytest
 
 from file_replicator.tar_adapter import (
+    FILES_FROM,
+    PAX,
+    SPARSE,
     BsdTarAdapter,
     BusyBoxTarAdapter,
     GnuTarAdapter,
@@ -41,6 +44,45 @@ def test_bsd_tar_adapter():
     assert tar.sender_cmd("foo") == [f"tar", "-c", "-f", "-", "foo"]
 
 
+def test_capabilities():
+    tar = GnuTarAdapter()
+    assert tar.capabilities == {FILES_FROM}
+    assert tar.sender_files_from_cmd() == [
+        "tar",
+        "--null",
+        "--files-from=-",
+        "--create",
+        "--to-stdout",
+        "--ignore-failed-read",
+    ]
+    tar.capabilities = frozenset([SPARSE, PAX])
+    assert tar.sender_cmd("foo")[:3] == ["tar", "--format=pax", "--sparse"]
+    with pytest.raises(ValueError):
+        tar.sender_files_from_cmd()
+
+    # The receiver must be able to handle pax too.
+    assert tar.negotiate(GnuTarAdapter()).capabilities == {SPARSE}
+    assert tar.negotiate(tar).capabilities == {SPARSE, PAX}
+    assert BusyBoxTarAdapter().capabilities == set()
+
+
+def test_probe_capabilities():
+    tar = GnuTarAdapter()
+    scripts = []
+
+    def run_script(script):
+        scripts.append(script)
+        return "sparse\nunknown\n"
+
+    tar.probe_capabilities(run_script)
+    assert tar.capabilities == {SPARSE}
+    assert "--files-from=-" in scripts[0]
+
+    tar = detect_local_tar()
+    if isinstance(tar, GnuTarAdapter):
+        assert tar.capabilities == {FILES_FROM, SPARSE, PAX}
+
+
 # not so useful, but here we go
 def test_detect_real_local_tar():
     tar = detect_local_tar()
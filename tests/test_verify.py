@@ -0,0 +1,117 @@
+import os
+import os.path
+import shlex
+import shutil
+
+from click.testing import CliRunner
+
+from file_replicator.cli import main
+from file_replicator.lib import make_file_replicator, replicate_all_files
+from file_replicator.verify import (
+    CHILD_DIGESTS_CODE,
+    ROOT_DIGEST_CODE,
+    HashTree,
+    find_differences,
+    nul_separated,
+    reconcile,
+    run_remote,
+)
+
+from .conftest import assert_file_contains, make_test_file, temp_directory
+
+
+def make_test_files(src_dir):
+    make_test_file(src_dir, ".gitignore", "*.log\n")
+    make_test_file(src_dir, "a.txt", "hello")
+    make_test_file(src_dir, "b/c.txt", "hello")
+    make_test_file(src_dir, "b/d/e.txt", "hello")
+    make_test_file(src_dir, "b/d/f\\g h.txt", "hello")
+    make_test_file(src_dir, "x/y/z.txt", "hello")
+
+
+def test_local_and_remote_digests_agree():
+    with temp_directory() as src_dir, temp_directory() as cache_dir:
+        make_test_files(src_dir)
+        local = HashTree.from_src_dir(src_dir)
+        cache = shlex.quote(os.path.join(cache_dir, "cache"))
+        root = run_remote(
+            ("bash",),
+            ROOT_DIGEST_CODE.format(cache=cache, dest_dir=shlex.quote(src_dir)),
+            nul_separated(local.directories())
+            + b"\0"
+            + nul_separated(local.sorted_files + ["gone.txt"]),
+        ).split(b"\0")
+        assert root[-5:] == [b"m", b"gone.txt", b"d", local.digest(".").encode(), b""]
+
+        paths = [".gitignore", "a.txt", "b/c.txt", "b/d", "x"]
+        ranges = [local.line_range(path) for path in paths]
+        remote = run_remote(
+            ("bash",),
+            CHILD_DIGESTS_CODE.format(cache=cache),
+            "".join(f"{first + 1} {last}\n" for first, last in ranges).encode(),
+        )
+        digests = dict(reversed(line.split()) for line in remote.decode().splitlines())
+        assert digests == {
+            str(number): local.digest(path) for number, path in enumerate(paths, 1)
+        }
+
+
+def test_ignored_files_in_the_destination_make_no_difference(local_tar):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        dest_dir = os.path.join(dest_parent_dir, "test")
+        make_test_files(src_dir)
+        make_test_file(src_dir, ".gitignore", "*.log\n__pycache__/\n")
+        with make_file_replicator(
+            local_tar, local_tar, src_dir, dest_parent_dir, ("bash",)
+        ) as copy_file:
+            replicate_all_files(src_dir, copy_file)
+        make_test_file(dest_dir, "b/d/run.log", "ignored")
+        make_test_file(dest_dir, "b/__pycache__/c.pyc", "ignored")
+        report = find_differences(src_dir, dest_parent_dir, ("bash",))
+        assert report == ([], [], 1)
+
+
+def test_find_and_reconcile_differences(local_tar):
+    with temp_directory() as src_parent_dir, temp_directory() as dest_parent_dir:
+        src_dir = os.path.join(src_parent_dir, "test")
+        dest_dir = os.path.join(dest_parent_dir, "test")
+        make_test_files(src_dir)
+        with make_file_replicator(
+            local_tar, local_tar, src_dir, dest_parent_dir, ("bash",)
+        ) as copy_file:
+            replicate_all_files(src_dir, copy_file)
+        report = find_differences(src_dir, dest_parent_dir, ("bash",))
+        assert report.differing_files == []
+        assert report.extra_paths == []
+        assert report.round_trips == 1
+
+        # Drift in the destination.
+        make_test_file(dest_dir, "b/d/e.txt", "changed")
+        make_test_file(dest_dir, "b/d/new.txt", "new")
+        make_test_file(dest_dir, "b/d/new.log", "ignored")
+        shutil.rmtree(os.path.join(dest_dir, "x"))
+        report = find_differences(src_dir, dest_parent_dir, ("bash",))
+        assert sorted(report.differing_files) == ["b/d/e.txt", "x/y/z.txt"]
+        assert report.extra_paths == ["b/d/new.txt"]
+        assert report.round_trips == 4
+
+        with make_file_replicator(
+            local_tar, local_tar, src_dir, dest_parent_dir, ("bash",)
+        ) as copy_file:
+            reconcile(src_dir, dest_parent_dir, ("bash",), copy_file)
+        assert_file_contains(os.path.join(dest_dir, "b/d/e.txt"), "hello")
+        assert_file_contains(os.path.join(dest_dir, "x/y/z.txt"), "hello")
+        report = find_differences(src_dir, dest_parent_dir, ("bash",))
+        assert report.differing_files == []
+        assert report.extra_paths == ["b/d/new.txt"]
+
+
+def test_reconcile_is_refused_with_several_destinations():
+    with temp_directory() as src_dir:
+        result = CliRunner().invoke(
+            main,
+            [src_dir, "/dest", "--reconcile", "--also-to", "/other", "bash", "bash"],
+        )
+    assert result.exit_code == 2
+    assert "--also-to" in result.output